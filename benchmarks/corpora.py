@@ -0,0 +1,167 @@
+"""Synthetic PDF, DOCX and CSV review corpora for the benchmarks.
+
+Everything is written with the standard library (plus the repo's own
+dependencies), so corpora of any size can be generated offline:
+
+    python benchmarks/corpora.py --output corpora --rows 1000 10000 100000
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+PRODUCTS = ["Acme X200", "Acme X300 Pro", "Nimbus Buds", "Volt Charger", "Orbit Watch"]
+OPENINGS = [
+    "I bought this for my daughter and", "After two weeks of daily use", "Honestly", "Out of the box",
+    "Compared to my old one", "For the price", "Customer support said", "The delivery was late but",
+]
+FINDINGS = [
+    "the battery lasts all day", "the battery drains overnight", "the screen is bright and sharp",
+    "the screen cracked after a drop", "the charger stopped working", "the sound is clear with deep bass",
+    "the strap feels cheap", "setup took five minutes", "the app keeps crashing after the update",
+    "the refund took three weeks", "it fits perfectly", "the buttons are hard to press",
+]
+REQUESTS = [
+    "Please add a dark mode.", "I wish it came with a case.", "A longer cable would help.",
+    "Would love a cheaper version.", "Fix the sync bug please.", "",
+]
+
+
+def review(rng):
+    sentences = [f"{rng.choice(OPENINGS)} {rng.choice(FINDINGS)}."]
+    sentences += [f"Also {rng.choice(FINDINGS)}." for _ in range(rng.randint(0, 3))]
+    sentences.append(rng.choice(REQUESTS))
+    return " ".join(s for s in sentences if s)
+
+
+def reviews(rows, seed=0):
+    rng = random.Random(seed)
+    for i in range(rows):
+        yield {
+            "id": i,
+            "product": rng.choice(PRODUCTS),
+            "rating": rng.randint(1, 5),
+            "title": rng.choice(FINDINGS).capitalize(),
+            "content": review(rng),
+            "date": f"2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        }
+
+
+def write_csv(path, rows, seed=0):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["id", "product", "rating", "title", "content", "date"])
+        writer.writeheader()
+        writer.writerows(reviews(rows, seed))
+
+
+def write_docx(path, rows, seed=0):
+    # The smallest package Word opens: content types, the package relationship
+    # and the document part, one paragraph per review
+    body = "".join(
+        f"<w:p><w:r><w:t>{escape(r['title'])}. {escape(r['content'])}</w:t></w:r></w:p>"
+        for r in reviews(rows, seed)
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>',
+        )
+        archive.writestr(
+            "_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="word/document.xml"/></Relationships>',
+        )
+        archive.writestr(
+            "word/document.xml",
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{body}</w:body></w:document>",
+        )
+
+
+def pdf_text(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, rows, seed=0, lines_per_page=48, line_chars=95):
+    # A plain PDF 1.4 file with one Helvetica text stream per page
+    lines = []
+    for r in reviews(rows, seed):
+        text = f"{r['title']}. {r['content']}"
+        while text:
+            cut = text.rfind(" ", 0, line_chars) if len(text) > line_chars else len(text)
+            cut = cut if cut > 0 else line_chars
+            lines.append(text[:cut])
+            text = text[cut:].lstrip()
+        lines.append("")
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[""]]
+
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages))), len(pages)
+        ),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, page in enumerate(pages):
+        stream = "BT /F1 10 Tf 14 TL 50 760 Td " + " ".join(f"({pdf_text(line)}) Tj T*" for line in page) + " ET"
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+        xref = f.tell()
+        f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode("latin-1"))
+        f.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1"))
+
+
+WRITERS = {"csv": write_csv, "docx": write_docx, "pdf": write_pdf}
+
+
+def generate(output, sizes, formats=tuple(WRITERS), seed=0):
+    # Returns [{"format", "rows", "path", "bytes"}] for every generated file;
+    # files that already exist are reused
+    os.makedirs(output, exist_ok=True)
+    files = []
+    for rows in sizes:
+        for extension in formats:
+            path = os.path.join(output, f"reviews_{rows}.{extension}")
+            if not os.path.exists(path):
+                WRITERS[extension](path, rows, seed)
+            files.append({"format": extension, "rows": rows, "path": path, "bytes": os.path.getsize(path)})
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="corpora")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--formats", nargs="+", default=list(WRITERS), choices=list(WRITERS))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(generate(args.output, args.rows, args.formats, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""End-to-end benchmarks of extraction, the Flask routes, the Streamlit
+analysis functions and semantic search, against a local OpenAI stub.
+
+Generates PDF/DOCX/CSV corpora of increasing size, starts the stub from
+openai_stub.py and the apps on local ports, and measures:
+
+  extraction   read_document throughput per format and size
+  routes       p50/p99 latency per analysis route of the Flask app,
+               sequential, cache misses
+  concurrency  throughput and latency with N requests in flight against the
+               async server (async_app.py) run as W worker processes on one port
+  streamlit    the parable_streamlit analysis functions called directly
+  search       semantic_search.print_answer latency, cold and cached
+
+Results are written as JSON so runs can be compared between releases.
+
+    python benchmarks/load_benchmark.py --rows 1000 10000 --concurrency 1 4 16 --workers 1 4 --output load.json
+"""
+import argparse
+import importlib.util
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import corpora
+import openai_stub
+
+SCENARIOS = ("extraction", "routes", "concurrency", "streamlit", "search")
+ROUTES = ("/sentiment-analysis", "/entity_recognition", "/topic-modelling", "/trend-analysis", "/analyse")
+STREAMLIT_FUNCTIONS = ("sentiment_analysis", "entity_recognition", "topic_modelling", "actionable_insights")
+QUESTIONS = [
+    "How long does the battery last?", "Do people complain about the charger?", "Is the screen bright?",
+    "How long do refunds take?", "Does the app crash?", "Is the strap good quality?",
+]
+
+
+def summarise(latencies):
+    values = np.asarray(latencies) * 1000
+    return {
+        "count": len(values),
+        "p50_ms": float(np.percentile(values, 50)) if len(values) else None,
+        "p99_ms": float(np.percentile(values, 99)) if len(values) else None,
+        "mean_ms": float(values.mean()) if len(values) else None,
+    }
+
+
+def load_module(name, path):
+    # parable_app and parable_streamlit both call their entry module app.py
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class NamedBytes(io.BytesIO):
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def extraction(files, repeat):
+    from parable_core.ingestion import read_document
+
+    results = []
+    for entry in files:
+        with open(entry["path"], "rb") as f:
+            data = f.read()
+        timings, chars = [], 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            chars = len(read_document(NamedBytes(data, entry["path"]), max_chars=0))
+            timings.append(time.perf_counter() - start)
+        seconds = float(np.median(timings))
+        results.append({
+            "format": entry["format"],
+            "rows": entry["rows"],
+            "bytes": entry["bytes"],
+            "chars": chars,
+            "seconds": seconds,
+            "mb_per_second": entry["bytes"] / seconds / 1e6,
+        })
+    return results
+
+
+def serve_flask(app):
+    import logging
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name="flask").start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def serve_async(workers):
+    # `workers` async_app.py processes sharing one port through SO_REUSEPORT;
+    # they inherit the stub's address and the run's environment
+    import requests
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "parable_app", "async_app.py"), "--host", "127.0.0.1",
+             "--port", str(port)],
+            stdout=subprocess.DEVNULL,
+        )
+        for _ in range(workers)
+    ]
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            requests.get(base_url + "/metrics", timeout=1)
+            break
+        except requests.ConnectionError:
+            if time.monotonic() > deadline or any(p.poll() is not None for p in processes):
+                stop(processes)
+                raise RuntimeError("async_app.py did not start")
+            time.sleep(0.2)
+    # The first process to listen answered; give the others time to join
+    time.sleep(1)
+    return processes, base_url
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def post(base_url, route, path, run):
+    import requests
+
+    with open(path, "rb") as f:
+        start = time.perf_counter()
+        response = requests.post(
+            base_url + route,
+            files={"file": (os.path.basename(path), f)},
+            # A different custom parameter per request keeps the response cache cold
+            data={"custom_parameters": f"benchmark run {run}", "insight": "product reviews"},
+            timeout=600,
+        )
+    return time.perf_counter() - start, response.status_code
+
+
+def routes(base_url, path, requests_per_route):
+    results = {}
+    run = 0
+    for route in ROUTES:
+        latencies, errors = [], 0
+        for _ in range(requests_per_route):
+            run += 1
+            elapsed, status = post(base_url, route, path, f"{route}-{run}")
+            latencies.append(elapsed)
+            errors += status != 200
+        results[route] = {**summarise(latencies), "errors": errors}
+    return results
+
+
+def concurrency(path, workers, levels, requests_per_level):
+    results = []
+    for count in workers:
+        processes, base_url = serve_async(count)
+        try:
+            results.extend(
+                {"workers": count, **result}
+                for result in in_flight(base_url, path, levels, requests_per_level, f"w{count}")
+            )
+        finally:
+            stop(processes)
+    return results
+
+
+def in_flight(base_url, path, levels, requests_per_level, run):
+    results = []
+    for level in levels:
+        total = max(requests_per_level, level)
+        with ThreadPoolExecutor(max_workers=level) as pool:
+            start = time.perf_counter()
+            outcomes = list(pool.map(
+                lambda i: post(base_url, "/sentiment-analysis", path, f"concurrency-{run}-{level}-{i}"), range(total)
+            ))
+            wall = time.perf_counter() - start
+        results.append({
+            "in_flight": level,
+            "requests": total,
+            "seconds": wall,
+            "requests_per_second": total / wall,
+            "errors": sum(status != 200 for _, status in outcomes),
+            **summarise([elapsed for elapsed, _ in outcomes]),
+        })
+    return results
+
+
+def streamlit(module, path, calls):
+    with open(path, "rb") as f:
+        data = f.read()
+    results = {}
+    for name in STREAMLIT_FUNCTIONS:
+        function = getattr(module, name)
+        latencies = []
+        for i in range(calls):
+            start = time.perf_counter()
+            function(NamedBytes(data, path), f"benchmark run {i}", "product reviews")
+            latencies.append(time.perf_counter() - start)
+        results[name] = summarise(latencies)
+    return results
+
+
+def search(pdf_path, questions):
+    sys.path.append(os.path.join(ROOT, "parable_streamlit"))
+    try:
+        import semantic_search
+    except ImportError as error:
+        return {"skipped": f"semantic_search needs its dependencies: {error}"}
+
+    start = time.perf_counter()
+    semantic_search.search_index(semantic_search.source_docs(pdf_path))
+    build = time.perf_counter() - start
+
+    cold, cached = [], []
+    for question in questions:
+        start = time.perf_counter()
+        semantic_search.print_answer(question)
+        cold.append(time.perf_counter() - start)
+    for question in questions:
+        start = time.perf_counter()
+        semantic_search.print_answer(question)
+        cached.append(time.perf_counter() - start)
+    return {
+        "index_seconds": build,
+        "chunks": len(semantic_search.get_index().docs),
+        "cold": summarise(cold),
+        "cached": summarise(cached),
+        "qa_cache": dict(semantic_search.qa_cache.stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--corpora", default=None, help="directory for generated corpora, reused between runs")
+    parser.add_argument("--route-rows", type=int, default=None, help="CSV size for the route scenarios")
+    parser.add_argument("--requests", type=int, default=20, help="requests per route")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="async server processes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--tokens-per-second", type=float, default=0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of stub requests answered with 429")
+    # The client-side rate limiter would otherwise dominate every timing
+    parser.add_argument("--rpm", type=int, default=1_000_000, help="PARABLE_OPENAI_RPM for the run")
+    parser.add_argument("--tpm", type=int, default=1_000_000_000, help="PARABLE_OPENAI_TPM for the run")
+    parser.add_argument("--output", default="load_benchmark.json")
+    args = parser.parse_args()
+
+    # Fresh caches and index for every run, so results measure work not hits
+    workdir = tempfile.mkdtemp(prefix="parable-benchmark-")
+    os.environ["PARABLE_CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["PARABLE_INDEX_PATH"] = os.path.join(workdir, "search_index")
+    os.environ["PARABLE_EMBEDDING_CACHE"] = os.path.join(workdir, "embeddings.sqlite3")
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ["PARABLE_OPENAI_RPM"] = str(args.rpm)
+    os.environ["PARABLE_OPENAI_TPM"] = str(args.tpm)
+
+    import openai
+
+    stub = openai_stub.Stub(args.latency, args.jitter, args.tokens_per_second, args.rate_limit)
+    openai.api_base = openai_stub.start(stub)
+    openai.api_key = "stub"
+    # For the async server processes
+    os.environ["OPENAI_API_BASE"] = openai.api_base
+
+    corpus_dir = args.corpora or os.path.join(workdir, "corpora")
+    files = corpora.generate(corpus_dir, args.rows)
+    # Existing files are reused, so this only writes a CSV when --route-rows is a new size
+    route_csv = corpora.generate(corpus_dir, [args.route_rows or min(args.rows)], ["csv"])[0]["path"]
+
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "started": time.time(),
+    }
+    if "extraction" in args.scenarios:
+        results["extraction"] = extraction(files, args.repeat)
+    if "routes" in args.scenarios:
+        flask_app = load_module("parable_flask_app", os.path.join(ROOT, "parable_app", "app.py"))
+        server, base_url = serve_flask(flask_app.app)
+        results["routes"] = routes(base_url, route_csv, args.requests)
+        server.shutdown()
+    if "concurrency" in args.scenarios:
+        results["concurrency"] = concurrency(route_csv, args.workers, args.concurrency, args.requests)
+    if "streamlit" in args.scenarios:
+        module = load_module("parable_streamlit_app", os.path.join(ROOT, "parable_streamlit", "app.py"))
+        results["streamlit"] = streamlit(module, route_csv, max(1, args.requests // 4))
+    if "search" in args.scenarios:
+        pdf = next(f["path"] for f in files if f["format"] == "pdf" and f["rows"] == min(args.rows))
+        results["search"] = search(pdf, QUESTIONS)
+    results["stub"] = dict(stub.stats)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
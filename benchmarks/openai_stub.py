@@ -0,0 +1,228 @@
+"""Local stand-in for the OpenAI chat, completions and embeddings endpoints.
+
+Answers every request with well-formed JSON after a configurable latency and
+generation rate, and turns a configurable share of requests into 429s, so the
+apps can be load-tested without an API key or a bill. Point openai at it with
+openai.api_base = "http://127.0.0.1:8900/v1".
+
+    python benchmarks/openai_stub.py --port 8900 --latency 0.3 --tokens-per-second 80 --rate-limit 0.02
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+import numpy as np
+from aiohttp import web
+
+EMBEDDING_DIMENSION = 1536
+
+# One object carrying every field the analysis schemas ask for, so any
+# analysis prompt gets a parseable answer
+ANSWER = {
+    "positive_words": ["battery lasts all day", "bright screen"],
+    "negative_words": ["charger stopped working", "refund took three weeks"],
+    "neutral_words": ["setup took five minutes"],
+    "named_entities": ["Acme X200", "Volt Charger"],
+    "list_of_entity types": ["product"],
+    "contextual_info": [{"entity": "Acme X200", "context": "the battery lasts all day"}],
+    "entity_occurrences": [{"entity": "Acme X200", "count": 1}],
+    "topics": ["battery", "delivery"],
+    "types": {"critique": ["charger stopped working"], "feature suggestions": ["dark mode"]},
+    "topic_distribution": [{"label": "battery", "value": [0.6]}, {"label": "delivery", "value": [0.4]}],
+    "topic_keywords": [{"topic": "battery", "keywords": ["battery", "charge"]}],
+    "topic_hierarchy": [],
+    "word_cloud": "battery screen charger refund",
+    "actionable_insights": ["Improve charger durability", "Speed up refunds"],
+    "common_requests": [{"common request": "dark mode"}],
+    "common_suggestions": [{"common suggestion": "ship a case"}],
+    "common_criticisms": [{"common criticisms": "slow refunds"}],
+    "custom_parameters": "Not specified.",
+    "summary": "Customers like the battery and screen but report charger failures and slow refunds.",
+}
+ROW_ID = re.compile(r"^\[(\d+)\]", re.MULTILINE)
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def answer_for(prompt):
+    # Per-row batch prompts get one object per row id, everything else the
+    # shared answer object
+    ids = ROW_ID.findall(prompt)
+    if ids:
+        return json.dumps([
+            {"id": int(i), "sentiment": ("positive", "negative", "neutral")[int(i) % 3],
+             "score": (1, -1, 0)[int(i) % 3], "phrases": ["battery"]}
+            for i in ids
+        ])
+    return json.dumps(ANSWER)
+
+
+def embedding(text):
+    seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+    vector = np.random.default_rng(seed).normal(size=EMBEDDING_DIMENSION)
+    return (vector / np.linalg.norm(vector)).round(6).tolist()
+
+
+class Stub:
+    def __init__(self, latency=0.2, jitter=0.1, tokens_per_second=0, rate_limit=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.rate_limit = rate_limit
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "rate_limited": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    async def wait(self, completion_tokens=0):
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if self.tokens_per_second:
+            delay += completion_tokens / self.tokens_per_second
+        await asyncio.sleep(delay)
+
+    def throttled(self):
+        self.stats["requests"] += 1
+        if self.rng.random() < self.rate_limit:
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (stub)", "type": "requests", "code": None}},
+                status=429,
+            )
+        return None
+
+    def usage(self, prompt, content):
+        usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(content)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        self.stats["prompt_tokens"] += usage["prompt_tokens"]
+        self.stats["completion_tokens"] += usage["completion_tokens"]
+        return usage
+
+    async def chat(self, request):
+        throttled = self.throttled()
+        if throttled:
+            return throttled
+        body = await request.json()
+        prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+        content = answer_for(prompt)
+        created = int(time.time())
+        if not body.get("stream"):
+            await self.wait(estimate_tokens(content))
+            return web.json_response({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": self.usage(prompt, content),
+            })
+
+        # Server-sent events, one delta per ~4 characters at the configured rate
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await self.wait()
+        self.usage(prompt, content)
+        for start in range(0, len(content), 16):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "delta": {"content": content[start:start + 16]}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            if self.tokens_per_second:
+                await asyncio.sleep(4 / self.tokens_per_second)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def completions(self, request):
+        # The legacy completions endpoint langchain's OpenAI LLM calls
+        throttled = self.throttled()
+        if throttled:
+            return throttled
+        body = await request.json()
+        prompts = body.get("prompt")
+        prompts = prompts if isinstance(prompts, list) else [prompts or ""]
+        text = " The battery lasts all day according to most reviews.\nSOURCES: reviews"
+        await self.wait(estimate_tokens(text))
+        return web.json_response({
+            "id": "cmpl-stub",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": i, "text": text, "finish_reason": "stop", "logprobs": None}
+                        for i in range(len(prompts))],
+            "usage": self.usage("\n".join(prompts), text),
+        })
+
+    async def embeddings(self, request):
+        throttled = self.throttled()
+        if throttled:
+            return throttled
+        body = await request.json()
+        inputs = body.get("input")
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        await self.wait()
+        tokens = sum(estimate_tokens(str(text)) for text in inputs)
+        self.stats["prompt_tokens"] += tokens
+        return web.json_response({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": embedding(str(text))}
+                     for i, text in enumerate(inputs)],
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def application(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/v1/completions", self.completions)
+        app.router.add_post("/v1/engines/{engine}/completions", self.completions)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_post("/v1/engines/{engine}/embeddings", self.embeddings)
+        return app
+
+
+def start(stub, host="127.0.0.1", port=0):
+    # Serve the stub on a background thread; returns its /v1 base URL
+    ready = threading.Event()
+    address = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(stub.application())
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, host, port)
+        loop.run_until_complete(site.start())
+        address["port"] = runner.addresses[0][1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True, name="openai-stub").start()
+    ready.wait()
+    return f"http://{host}:{address['port']}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.1, help="extra random latency, seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="generation rate, 0 for instant")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of requests answered with 429")
+    args = parser.parse_args()
+    stub = Stub(args.latency, args.jitter, args.tokens_per_second, args.rate_limit)
+    web.run_app(stub.application(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Retrieval latency and recall for the semantic search index types.
+
+Builds a synthetic corpus of clustered vectors and keyword-bearing texts and
+loads it, document by document, through the VectorIndex the semantic search
+uses, one index per FAISS description. For each it measures per-query latency
+(p50/p99) and recall@k against exact search for vector search, and latency
+and SKU hit rate for the BM25 and hybrid (RRF) search paths. Nothing is
+embedded, so no API key is needed.
+
+    python benchmarks/retrieval_benchmark.py --chunks 200000 --output retrieval.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "parable_streamlit"))
+
+import faiss
+from langchain.docstore.document import Document
+from vector_index import VectorIndex
+
+WORDS = (
+    "battery screen charger cable delivery refund price quality sound camera "
+    "strap button case colour size fit warranty support update app"
+).split()
+
+
+def percentile(values, q):
+    return float(np.percentile(np.asarray(values) * 1000, q))
+
+
+def synthetic_corpus(n, dimension, clusters, seed):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dimension)).astype("float32")
+    labels = rng.integers(0, clusters, size=n)
+    vectors = centres[labels] + 0.3 * rng.normal(size=(n, dimension)).astype("float32")
+    texts = [
+        " ".join(rng.choice(WORDS, size=12)) + f" sku-{i % 5000}"
+        for i in range(n)
+    ]
+    return vectors.astype("float32"), texts
+
+
+def time_queries(search, queries):
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+
+def build(description, vectors, texts, document_chunks, search_params):
+    # Add the corpus one "document" at a time, as ingestion does, so indexes
+    # that need training go through the same staging as in production
+    index = VectorIndex(None, factory=description, search_params=search_params)
+    for start in range(0, len(texts), document_chunks):
+        end = start + document_chunks
+        documents = [
+            Document(page_content=text, metadata={"source": f"doc-{start // document_chunks}"})
+            for text in texts[start:end]
+        ]
+        index.add_vectors(documents, vectors[start:end])
+    return index
+
+
+def sku_hit_rate(texts, queries, rankings):
+    # A keyword hit is a result carrying the query's exact SKU
+    return float(np.mean([
+        any(texts[i].endswith(q.split()[-1]) for i in ranking) for q, ranking in zip(queries, rankings)
+    ]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--indexes", nargs="+",
+        default=["IDMap2,Flat", "IDMap2,IVF1024,Flat", "IDMap2,HNSW32"],
+    )
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--document-chunks", type=int, default=500, help="chunks added per add_vectors call")
+    parser.add_argument("--output", default="retrieval_benchmark.json")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors, texts = synthetic_corpus(args.chunks, args.dimension, 256, args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    picks = rng.integers(0, args.chunks, size=args.queries)
+    query_vectors = vectors[picks] + 0.1 * rng.normal(size=(args.queries, args.dimension)).astype("float32")
+    query_texts = [f"{WORDS[i % len(WORDS)]} sku-{p % 5000}" for i, p in enumerate(picks)]
+
+    exact = faiss.IndexFlatL2(args.dimension)
+    exact.add(vectors)
+    _, truth = exact.search(query_vectors, args.k)
+
+    results = {
+        "chunks": args.chunks,
+        "dimension": args.dimension,
+        "queries": args.queries,
+        "k": args.k,
+        "indexes": [],
+    }
+    index = None
+    for description in args.indexes:
+        params = []
+        if "IVF" in description:
+            params.append(f"nprobe={args.nprobe}")
+        if "HNSW" in description:
+            params.append(f"efSearch={args.ef_search}")
+        start = time.perf_counter()
+        index = build(description, vectors, texts, args.document_chunks, ",".join(params))
+        build_seconds = time.perf_counter() - start
+
+        latencies, found = time_queries(lambda q: [i for i, _ in index.search_vector(q, args.k)], query_vectors)
+        recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+        hybrid_latencies, hybrid = time_queries(
+            lambda pair: index.hybrid_ids(pair[0], pair[1], args.k), list(zip(query_texts, query_vectors))
+        )
+        results["indexes"].append({
+            "index": description,
+            "build_seconds": build_seconds,
+            # Still the exact stand-in if the corpus was too small to train on
+            "trained": not index.staged,
+            "vector": {
+                "p50_ms": percentile(latencies, 50),
+                "p99_ms": percentile(latencies, 99),
+                f"recall_at_{args.k}": float(recall),
+            },
+            "hybrid": {
+                "p50_ms": percentile(hybrid_latencies, 50),
+                "p99_ms": percentile(hybrid_latencies, 99),
+                f"sku_hit_rate_at_{args.k}": sku_hit_rate(texts, query_texts, hybrid),
+            },
+        })
+
+    # The keyword index is the same for every vector index, so it is timed once
+    latencies, keyword_rankings = time_queries(
+        lambda q: [i for i, _ in index.keywords.search(q, args.k)], query_texts
+    )
+    results["bm25"] = {
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        f"sku_hit_rate_at_{args.k}": sku_hit_rate(texts, query_texts, keyword_rankings),
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
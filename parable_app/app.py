@@ -1,12 +1,18 @@
 import os
+import sys
 import openai
 import json
-from flask import Flask, jsonify, redirect, render_template, request, url_for
-import pandas as pd
-import PyPDF2
-import docx2txt
+from flask import Flask, Response, g, jsonify, redirect, render_template, request, send_file, stream_with_context, url_for
 from flask_cors import CORS, cross_origin
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parable_core import jobs, metrics, scraper
+from parable_core.batch import BatchRun, read_rows, results_path
+from parable_core.ingestion import DocumentError, read_document, spool
+from parable_core.analyses import ANALYSES
+from parable_core.pipeline import run_analyses, run_analysis, stream_analysis
+
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -15,68 +21,85 @@ app = Flask(__name__)
 cors = CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
 
+# Analyses behind the four single-analysis routes, in the order the frontend shows them
+DEFAULT_ANALYSES = ["sentiment_analysis", "entity_recognition", "topic_modelling", "trend_analysis"]
+
+
+@app.errorhandler(DocumentError)
+def document_error(error):
+    return jsonify({"error": str(error)}), error.status_code
+
+@app.before_request
+def start_trace():
+    if request.endpoint != 'prometheus_metrics':
+        g.trace = metrics.start_trace(request.url_rule.rule if request.url_rule else 'unmatched')
+
+
+@app.after_request
+def record_status(response):
+    g.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_trace(error=None):
+    if 'trace' in g:
+        metrics.finish_trace(g.pop('trace'), g.get('status', 500))
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def uploaded_file():
+    # The upload, or with reviews=<collection> the reviews scraped into that
+    # collection, read as a CSV. Parsing the multipart body happens here.
+    with metrics.span("upload_read"):
+        collection = request.form.get('reviews')
+        if collection:
+            if not scraper.store.count(collection):
+                raise DocumentError(f"No scraped reviews in collection: {collection}")
+            return scraper.store.as_file(collection)
+        return request.files['file']
+
+
+def wants_job():
+    # Long documents can be analysed in the background: POST with async=true
+    # returns a job id straight away and the result is collected from /jobs/<id>
+    return request.form.get('async', '').lower() in ('1', 'true', 'yes')
 
-def extract_pdf_text(file):
-    # Read PDF file and extract text
-    text = ''
-    pdf_reader = PyPDF2.PdfReader(file)
-    for page_num in range(len(pdf_reader.pages)):
-        page = pdf_reader.pages[page_num]
-        text += page.extract_text()
-    return text
 
-def extract_doc_text(file):
-    # Read Word document file and extract text
-    text = docx2txt.process(file)
-    return text
+def submit_job(file, names, custom_para, insight, engine=None):
+    job_id = jobs.submit(spool(file), names, custom_para, insight, engine)
+    return jsonify({"job_id": job_id, "status_url": url_for('job_status', job_id=job_id)}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.store.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    return jsonify(job)
+
 
 @app.route('/sentiment-analysis', methods=('GET','POST'))
 def index():
     if request.method == "POST":
 
-        file = request.files['file']
-        if file.filename.endswith('.csv'):
-            data = pd.read_csv(request.files['file'])
-        elif file.filename.endswith('.pdf'):
-            data = extract_pdf_text(file)
-        elif file.filename.endswith('.doc') or file.filename.endswith('.docx'):
-            data = extract_doc_text(file)
+        file = uploaded_file()
         custom_para = request.form['custom_parameters']
         insight = request.form['insight']
+        if wants_job():
+            return submit_job(file, ["sentiment_analysis"], custom_para, insight)
+
+        data = read_document(file)
+        response = run_analysis("sentiment_analysis", data, custom_para, insight)
 
-        prompt = f'''
-        You are a text to insight service. Perform sentiment analysis on the following. Also consider the custom parameters field:
-        data: {data},
-        custom parameters: {custom_para},
-        insight: {insight},
-        '''
-        output = '''
-        Your output should be in the JSON format: 
-                {
-        "positive_words": [
-            "list of positive phrases"
-        ],
-        "negative_words": [
-            "list of negative phrases"
-        ],
-        "neutral_words": [
-            "list of neutral phrases"
-        ],
-        "custom_parameters": "answer to the custom parameters",
-        "summary": "summary goes here"
-        }
-
-        '''
-        prompt = prompt + output
-        prompt = [{"role": "user", "content":prompt}]
-        response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=prompt,
-                    temperature=0.6,
-                )
-        response = response.choices[0].message.content
-
-        return jsonify(response)
+        return jsonify(ANALYSES["sentiment_analysis"].load(response))
+
+    if request.args.get("job_id"):
+        return job_status(request.args["job_id"])
 
     response = request.args.get("output")
 
@@ -86,52 +109,19 @@ def index():
 def entity_recognition():
     if request.method == "POST":
 
-        file = request.files['file']
-        if file.filename.endswith('.csv'):
-            data = pd.read_csv(request.files['file'])
-        elif file.filename.endswith('.pdf'):
-            data = extract_pdf_text(file)
-        elif file.filename.endswith('.doc') or file.filename.endswith('.docx'):
-            data = extract_doc_text(file)
+        file = uploaded_file()
         custom_para = request.form['custom_parameters']
         insight = request.form['insight']
-        prompt = f'''You are a text to insight service. Perform entity recognition on the following. 
-        Also consider the custom parameters field. The insight tells a little about the data. 
-        Return list of named entities, list of entity types, contextual info (The context in which each named entity appears in the text, such as the surrounding words, sentences, or paragraphs.) and number of entity occurences.
-        data: {data},
-        custom parameters: {custom_para},
-        insight: {insight},
-        ''' 
-        output = '''
-        Return the output in the following JSON format:
-
-        {
-            "named_entities": [
-                "list of named entities"
-            ],
-            "list_of_entity types": [],
-            "contextual_info": [
-                {"entity": "entity", "context": "context"},
-                "..."
-            ],
-            "entity_occurrences": [
-                {"entity": "entity", "count": "count of entity occurrences"},
-                "..."
-            ],
-            "custom_parameters": "answer to the custom parameters",
-            "summary": "summary goes here"
-        }
-        '''
-        prompt = prompt + output
-        prompt = [{"role": "user", "content":prompt}]
-        response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=prompt,
-                    temperature=0.6,
-                )
-        response = response.choices[0].message.content
-
-        return jsonify(response)
+        if wants_job():
+            return submit_job(file, ["entity_recognition"], custom_para, insight)
+
+        data = read_document(file)
+        response = run_analysis("entity_recognition", data, custom_para, insight)
+
+        return jsonify(ANALYSES["entity_recognition"].load(response))
+
+    if request.args.get("job_id"):
+        return job_status(request.args["job_id"])
 
     response = request.args.get("output")
 
@@ -141,60 +131,21 @@ def entity_recognition():
 def topic_modelling():
     if request.method == "POST":
         
-        file = request.files['file']
-        if file.filename.endswith('.csv'):
-            data = pd.read_csv(request.files['file'])
-        elif file.filename.endswith('.pdf'):
-            data = extract_pdf_text(file)
-        elif file.filename.endswith('.doc') or file.filename.endswith('.docx'):
-            data = extract_doc_text(file)
+        file = uploaded_file()
         custom_para = request.form['custom_parameters']
         insight = request.form['insight']
-        prompt = f'''You are a text to insight service. Perform topic modelling on the following. 
-        Also consider the custom parameters field. Extract important phrases and analyse the type of phrase.
-        Types include feature suggestions, product improvements, suggestions, critique etc. Also return the 
-        topic distribution, topic keywords (list of keywords associated with each topic), topic hierarchy (how topics are related to each other) and word cloud (list of common occuring words):
-        data: {data},
-        custom parameters: {custom_para},
-        insight: {insight}'''
-
-        output = '''
-        Return the output in the following JSON format:
-
-        {
-            "topics": [
-                "list of topics"
-            ],
-            "types": {
-                "type1": ["phrase"],
-                "type2": ["phrase"],
-                "..."
-            },
-            "topic_distribution": [
-                {"label": "topic label", "value": "[list of topic distribution values]"}
-            ],
-            "topic_keywords": [
-                {"topic": "topic label", "keywords": "[list of keywords associated with the topic]"},
-                "..."
-            ],
-            "topic_hierarchy": "[topic hierarchy goes here]",
-            "word_cloud": "[word cloud goes here]",
-            "custom_parameters": "answer to the custom parameters",
-            "summary": "summary goes here"
-        }
-        '''
-        prompt = prompt + output
-
-        # Send prompt to OpenAI and get output 
-        prompt = [{"role": "user", "content":prompt}]
-        response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=prompt,
-                    temperature=0.6,
-                )
-        response = response.choices[0].message.content
-
-        return jsonify(response)
+        # engine=local models the topics locally and asks the LLM only for labels
+        engine = request.form.get('engine')
+        if wants_job():
+            return submit_job(file, ["topic_modelling"], custom_para, insight, engine)
+
+        data = read_document(file)
+        response = run_analysis("topic_modelling", data, custom_para, insight, engine=engine)
+
+        return jsonify(ANALYSES["topic_modelling"].load(response))
+
+    if request.args.get("job_id"):
+        return job_status(request.args["job_id"])
 
     response = request.args.get("output")
 
@@ -202,52 +153,185 @@ def topic_modelling():
 
 
 
-@app.route('/trend-analysis', methods=['POST'])
+@app.route('/trend-analysis', methods=('GET','POST'))
 def actionable_insights():
     if request.method == "POST":
 
-        file = request.files['file']
-        if file.filename.endswith('.csv'):
-            data = pd.read_csv(request.files['file'])
-        elif file.filename.endswith('.pdf'):
-            data = extract_pdf_text(file)
-        elif file.filename.endswith('.doc') or file.filename.endswith('.docx'):
-            data = extract_doc_text(file)
+        file = uploaded_file()
         custom_para = request.form['custom_parameters']
         insight = request.form['insight']
+        if wants_job():
+            return submit_job(file, ["trend_analysis"], custom_para, insight)
 
-        prompt = f'''
-        You are a text to insight service. Peform analysis and retrieve actionable insights from the following. Also consider the custom parameters field:
-        data: {data},
-        custom parameters: {custom_para},
-        insight: {insight},
-        '''
-        output = '''
-        Your output should be in the JSON format: 
-                {
-        "actionable_insights": [
-            "list of actionable insights"
-        ],
-        "custom_parameters": "answer to the custom parameters",
-        "summary": "summary goes here"
-        }
-
-        '''
-        prompt = prompt + output
-        prompt = [{"role": "user", "content":prompt}]
-        response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=prompt,
-                    temperature=0.6,
-                )
-        response = response.choices[0].message.content
-
-        return jsonify(response)
+        data = read_document(file)
+        response = run_analysis("trend_analysis", data, custom_para, insight)
+
+        return jsonify(ANALYSES["trend_analysis"].load(response))
+
+    if request.args.get("job_id"):
+        return job_status(request.args["job_id"])
 
     response = request.args.get("output")
 
     return jsonify(response)
 
 
-    
-   
+@app.route('/sentiment-analysis/batch', methods=['POST'])
+def sentiment_batch():
+    # Per-row sentiment for a CSV of reviews. The response carries the
+    # aggregates and the first `limit` rows; the full table is a Parquet file
+    # at results_url. Optional `columns` picks the text columns by name.
+    file = uploaded_file()
+    custom_para = request.form.get('custom_parameters', '')
+    insight = request.form.get('insight', '')
+    columns = [c.strip() for c in request.form.get('columns', '').split(',') if c.strip()] or None
+    batch = BatchRun(file, custom_para, insight, columns)
+    if wants_job():
+        job_id = jobs.submit_batch(batch)
+        return jsonify({
+            "job_id": job_id,
+            "status_url": url_for('job_status', job_id=job_id),
+            "results_url": url_for('batch_results', batch_id=batch.id),
+        }), 202
+
+    result = batch.run()
+    result["rows"] = read_rows(batch.id, limit=request.form.get('limit', 100, type=int))
+    result["results_url"] = url_for('batch_results', batch_id=batch.id)
+    return jsonify(result)
+
+
+@app.route('/batches/<batch_id>', methods=['GET'])
+def batch_results(batch_id):
+    # The whole table as Parquet, or a page of it as JSON with ?format=json
+    if not batch_id.isalnum():
+        return jsonify({"error": f"Unknown batch: {batch_id}"}), 404
+    if request.args.get('format') == 'json':
+        rows = read_rows(
+            batch_id, request.args.get('offset', 0, type=int), request.args.get('limit', 100, type=int)
+        )
+        if rows is None:
+            return jsonify({"error": f"Unknown batch: {batch_id}"}), 404
+        return jsonify({"rows": rows})
+    path = results_path(batch_id)
+    if not os.path.exists(path):
+        return jsonify({"error": f"Unknown batch: {batch_id}"}), 404
+    return send_file(path, mimetype='application/vnd.apache.parquet', as_attachment=True,
+                     download_name=f"{batch_id}.parquet")
+
+
+@app.route('/scrape', methods=['POST'])
+def scrape():
+    # Scrape review pages (comma or newline separated `urls`) into a named
+    # collection that the analysis routes then read with reviews=<collection>
+    urls = [
+        url.strip()
+        for value in request.form.getlist('urls')
+        for url in value.replace(',', '\n').split('\n')
+        if url.strip()
+    ]
+    collection = request.form.get('collection', '').strip()
+    if not urls or not collection:
+        return jsonify({"error": "urls and collection are required"}), 400
+    try:
+        for url in urls:
+            scraper.check_url(url)
+    except scraper.BlockedURL as error:
+        return jsonify({"error": str(error)}), 400
+    # At most scraper.MAX_PAGES, however many are asked for
+    max_pages = min(max(request.form.get('max_pages', scraper.MAX_PAGES, type=int), 1), scraper.MAX_PAGES)
+    if wants_job():
+        job_id = jobs.submit_scrape(urls, collection, max_pages)
+        return jsonify({"job_id": job_id, "status_url": url_for('job_status', job_id=job_id)}), 202
+    return jsonify(scraper.scrape_reviews(urls, collection, max_pages))
+
+
+@app.route('/reviews', methods=['GET'])
+def review_collections():
+    return jsonify(scraper.store.collections())
+
+
+@app.route('/analyse', methods=['POST'])
+def analyse():
+    # Parse the upload once and run any subset of the analyses over it concurrently.
+    # With stream=true each analysis is sent as its own NDJSON line as soon as it finishes.
+    file = uploaded_file()
+    custom_para = request.form['custom_parameters']
+    insight = request.form['insight']
+    # Applies to topic_modelling, as on /topic-modelling
+    engine = request.form.get('engine')
+
+    names = request.form.getlist('analyses') or DEFAULT_ANALYSES
+    names = list(dict.fromkeys(n.strip() for name in names for n in name.split(',') if n.strip()))
+    unknown = [name for name in names if name not in ANALYSES]
+    if unknown:
+        return jsonify({"error": f"Unknown analyses: {', '.join(unknown)}"}), 400
+    if wants_job():
+        return submit_job(file, names, custom_para, insight, engine)
+
+    report = {}
+    data = read_document(file, report=report)
+    results = run_analyses(names, data, custom_para, insight, engine=engine)
+
+    if request.form.get('stream', '').lower() in ('1', 'true', 'yes'):
+        def generate():
+            for name, response, error in results:
+                line = {"analysis": name, "output": response}
+                if error:
+                    line["error"] = error
+                yield json.dumps(line) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    output, errors = {name: None for name in names}, {}
+    for name, response, error in results:
+        output[name] = response
+        if error:
+            errors[name] = error
+    if errors:
+        output["errors"] = errors
+    if report:
+        output["document"] = report
+
+    return jsonify(output)
+
+
+def event_stream(name):
+    # Server-sent events: one `data:` message per text delta as the model
+    # writes it, then a `done` event carrying the complete output
+    file = uploaded_file()
+    data = read_document(file)
+    custom_para = request.form['custom_parameters']
+    insight = request.form['insight']
+    engine = request.form.get('engine')
+
+    def generate():
+        stream = stream_analysis(name, data, custom_para, insight, engine=engine)
+        try:
+            for delta in stream:
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+        except Exception as error:
+            yield f"event: error\ndata: {json.dumps({'error': str(error)})}\n\n"
+            return
+        yield f"event: done\ndata: {json.dumps({'output': ANALYSES[name].load(stream.output)})}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/sentiment-analysis/stream', methods=['POST'])
+def sentiment_analysis_stream():
+    return event_stream("sentiment_analysis")
+
+@app.route('/entity_recognition/stream', methods=['POST'])
+def entity_recognition_stream():
+    return event_stream("entity_recognition")
+
+@app.route('/topic-modelling/stream', methods=['POST'])
+def topic_modelling_stream():
+    return event_stream("topic_modelling")
+
+@app.route('/trend-analysis/stream', methods=['POST'])
+def trend_analysis_stream():
+    return event_stream("trend_analysis")
@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import io
+import os
+import sys
+
+import openai
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parable_core import metrics, scraper
+from parable_core.analyses import ANALYSES
+from parable_core.ingestion import DocumentError, DocumentTooLarge, read_document
+from parable_core.llm import open_session
+from parable_core.pipeline import arun_analysis, in_thread
+
+# The analysis routes of app.py served from one event loop per process:
+# every request awaits the model instead of pinning a worker thread, and all
+# API calls share one pooled keep-alive session. Run several processes on one
+# port for more CPU:
+#
+#     python parable_app/async_app.py --port 8000 &
+#     python parable_app/async_app.py --port 8000 &
+
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# Analyses one tenant may have in flight at once; more are refused with 429.
+# Tenants are named by the X-Tenant header, or else the client address.
+TENANT_CONCURRENCY = int(os.getenv("PARABLE_TENANT_CONCURRENCY", 32))
+MAX_UPLOAD_BYTES = int(os.getenv("PARABLE_MAX_UPLOAD_BYTES", 64 * 1024 * 1024))
+
+ROUTES = {
+    "/sentiment-analysis": "sentiment_analysis",
+    "/entity_recognition": "entity_recognition",
+    "/topic-modelling": "topic_modelling",
+    "/trend-analysis": "trend_analysis",
+}
+DEFAULT_ANALYSES = ["sentiment_analysis", "entity_recognition", "topic_modelling", "trend_analysis"]
+
+
+def tenant(request):
+    return request.headers.get("X-Tenant") or request.remote or "unknown"
+
+
+@web.middleware
+async def serve(request, handler):
+    # Request trace, the shared API session and the per-tenant limit
+    if request.path == "/metrics":
+        return await handler(request)
+    resource = request.match_info.route.resource
+    token = metrics.start_trace(resource.canonical if resource else "unmatched")
+    status = 500
+    try:
+        openai.aiosession.set(request.app["openai_session"])
+        name = tenant(request)
+        in_flight = request.app["in_flight"]
+        if in_flight.get(name, 0) >= TENANT_CONCURRENCY:
+            status = 429
+            return web.json_response(
+                {"error": f"Too many analyses in flight for tenant {name}"}, status=429, headers={"Retry-After": "1"}
+            )
+        in_flight[name] = in_flight.get(name, 0) + 1
+        try:
+            response = await handler(request)
+        finally:
+            in_flight[name] -= 1
+            if not in_flight[name]:
+                del in_flight[name]
+        status = response.status
+        return response
+    except DocumentError as error:
+        status = error.status_code
+        return web.json_response({"error": str(error)}, status=error.status_code)
+    except web.HTTPException as error:
+        status = error.status
+        raise
+    finally:
+        metrics.finish_trace(token, status)
+
+
+async def read_form(request):
+    # Form fields, and the upload read into memory under its file name
+    form, file = {}, None
+    with metrics.span("upload_read"):
+        if not request.content_type.startswith("multipart/"):
+            posted = await request.post()
+            form = {name: posted.getall(name) for name in posted}
+        else:
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    file = io.BytesIO()
+                    file.name = part.filename
+                    while True:
+                        chunk = await part.read_chunk()
+                        if not chunk:
+                            break
+                        file.write(chunk)
+                        if file.tell() > MAX_UPLOAD_BYTES:
+                            raise DocumentTooLarge(f"Uploads are limited to {MAX_UPLOAD_BYTES} bytes")
+                    file.seek(0)
+                else:
+                    form.setdefault(part.name, []).append(await part.text())
+    collection = form.get("reviews", [""])[0]
+    if collection:
+        if not await in_thread(scraper.store.count, collection):
+            raise DocumentError(f"No scraped reviews in collection: {collection}")
+        file = await in_thread(scraper.store.as_file, collection)
+    if file is None:
+        raise DocumentError("No file uploaded")
+    return form, file
+
+
+def field(form, name, default=""):
+    return form.get(name, [default])[0]
+
+
+async def analysis_route(request):
+    form, file = await read_form(request)
+    data = await in_thread(read_document, file)
+    name = ROUTES[request.path]
+    response = await arun_analysis(
+        name, data, field(form, "custom_parameters"), field(form, "insight"), engine=field(form, "engine", None)
+    )
+    return web.json_response(ANALYSES[name].load(response))
+
+
+async def analyse(request):
+    # /analyse of app.py: any subset of the analyses over one parsed upload
+    form, file = await read_form(request)
+    names = form.get("analyses") or DEFAULT_ANALYSES
+    names = list(dict.fromkeys(n.strip() for name in names for n in name.split(",") if n.strip()))
+    unknown = [name for name in names if name not in ANALYSES]
+    if unknown:
+        return web.json_response({"error": f"Unknown analyses: {', '.join(unknown)}"}, status=400)
+
+    report = {}
+    data = await in_thread(read_document, file, report=report)
+    custom_para, insight = field(form, "custom_parameters"), field(form, "insight")
+    engine = field(form, "engine", None)
+    results = await asyncio.gather(
+        *(arun_analysis(name, data, custom_para, insight, engine=engine) for name in names), return_exceptions=True
+    )
+    output, errors = {}, {}
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            output[name] = None
+            errors[name] = str(result)
+        else:
+            output[name] = ANALYSES[name].load(result)
+    if errors:
+        output["errors"] = errors
+    if report:
+        output["document"] = report
+    return web.json_response(output)
+
+
+async def prometheus_metrics(request):
+    return web.Response(text=metrics.registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def open_openai_session(app):
+    app["openai_session"] = open_session()
+    yield
+    await app["openai_session"].close()
+
+
+def create_app():
+    app = web.Application(middlewares=[serve])
+    app["in_flight"] = {}
+    app.cleanup_ctx.append(open_openai_session)
+    for path in ROUTES:
+        app.router.add_post(path, analysis_route)
+    app.router.add_post("/analyse", analyse)
+    app.router.add_get("/metrics", prometheus_metrics)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the analysis routes from an event loop")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    # reuse_port lets several processes accept on the same port
+    web.run_app(create_app(), host=args.host, port=args.port, reuse_port=True)
+
+
+if __name__ == "__main__":
+    main()
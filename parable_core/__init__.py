@@ -0,0 +1,2 @@
+# Shared document handling and analysis code used by both parable_app (Flask)
+# and parable_streamlit.
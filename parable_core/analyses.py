@@ -0,0 +1,440 @@
+import json
+import re
+
+from pydantic import ValidationError
+
+from parable_core.chunking import estimate_tokens
+from parable_core.schemas import (
+    ActionableInsightsResult,
+    EntityResult,
+    SentimentResult,
+    TopicResult,
+    TrendResult,
+    repair_json,
+)
+
+# Prompt templates and partial-result merging for each analysis. The map step
+# sends `instructions` + `output_format` for every chunk, the reduce step sends
+# the locally merged partials back through `reduce_prompt`.
+
+
+class Analysis:
+    def __init__(self, name, instructions, output_format, fields, schema, incremental=False):
+        self.name = name
+        self.instructions = instructions
+        self.output_format = output_format
+        # field name -> merge strategy, see MERGERS below
+        self.fields = fields
+        # pydantic model the final result is validated against
+        self.schema = schema
+        # Re-run on growing exports: chunk on content-defined boundaries and
+        # keep each chunk's partial result, so only new chunks are sent again
+        self.incremental = incremental
+
+    def prompt(self, data, custom_para, insight):
+        return self.instructions.format(
+            data=data, custom_para=custom_para, insight=insight
+        ) + self.output_format
+
+    def merge(self, partials):
+        merged = {}
+        for field, strategy in self.fields.items():
+            values = [p[field] for p in partials if isinstance(p, dict) and field in p]
+            merged[field] = MERGERS[strategy](values)
+        return merged
+
+    def reduce_prompt(self, merged, custom_para, insight, max_tokens):
+        merged = fit_to_budget(merged, max_tokens)
+        prompt = REDUCE_INSTRUCTIONS.format(
+            name=self.name.replace("_", " "),
+            merged=json.dumps(merged, ensure_ascii=False),
+            custom_para=custom_para,
+            insight=insight,
+        )
+        return prompt + self.output_format
+
+    def validate(self, value):
+        # (the fields that validate, {field: problem} for the rest)
+        if not isinstance(value, dict):
+            return {}, {field: "the answer was not a JSON object" for field in self.fields}
+        # Missing fields with a schema default just take it
+        required = {field.alias for field in self.schema.__fields__.values() if field.required}
+        problems = {field: "missing" for field in self.fields if field in required and field not in value}
+        try:
+            self.schema.parse_obj(value)
+        except ValidationError as error:
+            for problem in error.errors():
+                problems.setdefault(str(problem["loc"][0]), problem["msg"])
+        return {k: v for k, v in value.items() if k not in problems}, problems
+
+    def load(self, text):
+        # The result as a dict that always matches the schema. Fields that
+        # cannot be repaired locally are left at their empty defaults.
+        valid, _ = self.validate(repair_json(text))
+        return self.schema.parse_obj(valid).dict(by_alias=True)
+
+    def parse(self, text, complete=None):
+        # The answer as schema-valid JSON text. With `complete`, fields that
+        # local repair cannot save are asked for again on their own, from the
+        # broken part of the answer; the document is never sent again.
+        value = repair_json(text)
+        valid, problems = self.validate(value)
+        if problems and complete is not None:
+            valid = self.apply_fix(valid, problems, complete(self.fix_prompt(value, text, problems)))
+        return self.dump(valid)
+
+    async def aparse(self, text, acomplete=None):
+        # parse with the fix-up request awaited
+        value = repair_json(text)
+        valid, problems = self.validate(value)
+        if problems and acomplete is not None:
+            valid = self.apply_fix(valid, problems, await acomplete(self.fix_prompt(value, text, problems)))
+        return self.dump(valid)
+
+    def apply_fix(self, valid, problems, answer):
+        fixed = repair_json(answer)
+        if isinstance(fixed, dict):
+            valid, _ = self.validate({**valid, **{k: v for k, v in fixed.items() if k in problems}})
+        return valid
+
+    def dump(self, valid):
+        return json.dumps(self.schema.parse_obj(valid).dict(by_alias=True), ensure_ascii=False)
+
+    def fix_prompt(self, value, text, problems):
+        if isinstance(value, dict):
+            fragment = json.dumps({k: value[k] for k in problems if k in value}, ensure_ascii=False)
+        else:
+            fragment = text
+        return FIX_INSTRUCTIONS.format(
+            name=self.name.replace("_", " "),
+            problems="\n".join(f"{field}: {problem}" for field, problem in problems.items()),
+            fragment=fragment[:FIX_FRAGMENT_CHARS],
+            keys=", ".join(problems),
+        ) + self.output_format
+
+
+REDUCE_INSTRUCTIONS = '''
+        You are a text to insight service. A long document was split into parts and {name} was performed on each part.
+        The partial results below have already been merged. Consolidate them into a single result for the whole document:
+        remove duplicates, keep the most relevant items, write one summary and one answer to the custom parameters.
+        partial results: {merged},
+        custom parameters: {custom_para},
+        insight: {insight},
+        '''
+
+
+# The broken part of an answer is quoted back to the model up to this length
+FIX_FRAGMENT_CHARS = 8000
+FIX_INSTRUCTIONS = '''
+        You are a text to insight service. Part of your previous {name} answer was not valid:
+        {problems}
+        invalid part of your answer: {fragment},
+        Return a JSON object with only these keys, corrected: {keys}. Use the format below for them.
+        '''
+
+
+def _key(item):
+    if isinstance(item, str):
+        return item.strip().lower()
+    return json.dumps(item, sort_keys=True).lower()
+
+
+def merge_union(values):
+    # Concatenate lists preserving first-seen order, dropping duplicates
+    seen, merged = set(), []
+    for value in values:
+        for item in value if isinstance(value, list) else [value]:
+            if _key(item) not in seen:
+                seen.add(_key(item))
+                merged.append(item)
+    return merged
+
+
+def merge_texts(values):
+    # Free text (summaries, custom parameter answers) is left for the reduce prompt
+    return [v if isinstance(v, str) else json.dumps(v) for v in values if v]
+
+
+def merge_join(values):
+    return " ".join(v if isinstance(v, str) else " ".join(map(str, v)) for v in values if v)
+
+
+def merge_dict_of_lists(values):
+    merged = {}
+    for value in values:
+        if not isinstance(value, dict):
+            continue
+        for key, items in value.items():
+            merged.setdefault(key, []).append(items)
+    return {key: merge_union(items) for key, items in merged.items()}
+
+
+def _number(value):
+    if isinstance(value, list):
+        value = value[0] if value else 0
+    if isinstance(value, (int, float)):
+        return value
+    match = re.search(r"-?\d+(\.\d+)?", str(value))
+    return float(match.group()) if match else 0
+
+
+def merge_counts(values):
+    # [{"entity": e, "count": n}, ...] from every chunk -> summed counts per entity
+    totals = {}
+    for value in values:
+        for item in value if isinstance(value, list) else []:
+            if isinstance(item, dict) and "entity" in item:
+                entity = str(item["entity"])
+                totals[entity] = totals.get(entity, 0) + _number(item.get("count", 0))
+    return [
+        {"entity": entity, "count": int(count) if float(count).is_integer() else count}
+        for entity, count in sorted(totals.items(), key=lambda kv: -kv[1])
+    ]
+
+
+def merge_distribution(values):
+    # Average each topic's weight over the chunks, then renormalise to sum to 1
+    totals = {}
+    for value in values:
+        for item in value if isinstance(value, list) else []:
+            if isinstance(item, dict) and "label" in item:
+                label = str(item["label"])
+                totals[label] = totals.get(label, 0) + _number(item.get("value", 0))
+    total = sum(totals.values()) or 1
+    return [{"label": label, "value": [round(weight / total, 4)]} for label, weight in totals.items()]
+
+
+def merge_keywords(values):
+    keywords = {}
+    for value in values:
+        for item in value if isinstance(value, list) else []:
+            if isinstance(item, dict) and "topic" in item:
+                words = item.get("keywords", [])
+                keywords.setdefault(str(item["topic"]), []).append(words)
+    return [{"topic": topic, "keywords": merge_union(words)} for topic, words in keywords.items()]
+
+
+MERGERS = {
+    "union": merge_union,
+    "texts": merge_texts,
+    "join": merge_join,
+    "dict_of_lists": merge_dict_of_lists,
+    "counts": merge_counts,
+    "distribution": merge_distribution,
+    "keywords": merge_keywords,
+}
+
+
+def fit_to_budget(merged, max_tokens):
+    # Halve the longest list until the merged partials fit in one reduce prompt
+    merged = dict(merged)
+    while estimate_tokens(json.dumps(merged, ensure_ascii=False)) > max_tokens:
+        lists = [(len(v), k) for k, v in merged.items() if isinstance(v, list) and len(v) > 1]
+        strings = [(len(v), k) for k, v in merged.items() if isinstance(v, str) and len(v) > 200]
+        if lists:
+            _, key = max(lists)
+            merged[key] = merged[key][: len(merged[key]) // 2]
+        elif strings:
+            _, key = max(strings)
+            merged[key] = merged[key][: len(merged[key]) // 2]
+        else:
+            break
+    return merged
+
+
+SENTIMENT = Analysis(
+    "sentiment_analysis",
+    '''
+        You are a text to insight service. Perform sentiment analysis on the following. Also consider the custom parameters field:
+        data: {data},
+        custom parameters: {custom_para},
+        insight: {insight},
+        ''',
+    '''
+        Your output should be in the JSON format:
+                {
+        "positive_words": [
+            "list of positive phrases"
+        ],
+        "negative_words": [
+            "list of negative phrases"
+        ],
+        "neutral_words": [
+            "list of neutral phrases"
+        ],
+        "custom_parameters": "answer to the custom parameters",
+        "summary": "summary goes here"
+        }
+
+        ''',
+    {
+        "positive_words": "union",
+        "negative_words": "union",
+        "neutral_words": "union",
+        "custom_parameters": "texts",
+        "summary": "texts",
+    },
+    SentimentResult,
+)
+
+ENTITY_RECOGNITION = Analysis(
+    "entity_recognition",
+    '''You are a text to insight service. Perform entity recognition on the following.
+        Also consider the custom parameters field. The insight tells a little about the data.
+        Return list of named entities, list of entity types, contextual info (The context in which each named entity appears in the text, such as the surrounding words, sentences, or paragraphs.) and number of entity occurences.
+        data: {data},
+        custom parameters: {custom_para},
+        insight: {insight},
+        ''',
+    '''
+        Return the output in the following JSON format:
+
+        {
+            "named_entities": [
+                "list of named entities"
+            ],
+            "list_of_entity types": [],
+            "contextual_info": [
+                {"entity": "entity", "context": "context"},
+                "..."
+            ],
+            "entity_occurrences": [
+                {"entity": "entity", "count": "count of entity occurrences"},
+                "..."
+            ],
+            "custom_parameters": "answer to the custom parameters",
+            "summary": "summary goes here"
+        }
+        ''',
+    {
+        "named_entities": "union",
+        "list_of_entity types": "union",
+        "contextual_info": "union",
+        "entity_occurrences": "counts",
+        "custom_parameters": "texts",
+        "summary": "texts",
+    },
+    EntityResult,
+)
+
+TOPIC_MODELLING = Analysis(
+    "topic_modelling",
+    '''You are a text to insight service. Perform topic modelling on the following.
+        Also consider the custom parameters field. Extract important phrases and analyse the type of phrase.
+        Types include feature suggestions, product improvements, suggestions, critique etc. Also return the
+        topic distribution, topic keywords (list of keywords associated with each topic), topic hierarchy (how topics are related to each other) and word cloud (list of common occuring words):
+        data: {data},
+        custom parameters: {custom_para},
+        insight: {insight}''',
+    '''
+        Return the output in the following JSON format:
+
+        {
+            "topics": [
+                "list of topics"
+            ],
+            "types": {
+                "type1": ["phrase"],
+                "type2": ["phrase"],
+                "..."
+            },
+            "topic_distribution": [
+                {"label": "topic label", "value": "[list of topic distribution values]"}
+            ],
+            "topic_keywords": [
+                {"topic": "topic label", "keywords": "[list of keywords associated with the topic]"},
+                "..."
+            ],
+            "topic_hierarchy": "[topic hierarchy goes here]",
+            "word_cloud": "[word cloud goes here]",
+            "custom_parameters": "answer to the custom parameters",
+            "summary": "summary goes here"
+        }
+        ''',
+    {
+        "topics": "union",
+        "types": "dict_of_lists",
+        "topic_distribution": "distribution",
+        "topic_keywords": "keywords",
+        "topic_hierarchy": "texts",
+        "word_cloud": "join",
+        "custom_parameters": "texts",
+        "summary": "texts",
+    },
+    TopicResult,
+)
+
+# /trend-analysis in the Flask app
+TREND_ANALYSIS = Analysis(
+    "trend_analysis",
+    '''
+        You are a text to insight service. Peform analysis and retrieve actionable insights from the following. Also consider the custom parameters field:
+        data: {data},
+        custom parameters: {custom_para},
+        insight: {insight},
+        ''',
+    '''
+        Your output should be in the JSON format:
+                {
+        "actionable_insights": [
+            "list of actionable insights"
+        ],
+        "custom_parameters": "answer to the custom parameters",
+        "summary": "summary goes here"
+        }
+
+        ''',
+    {
+        "actionable_insights": "union",
+        "custom_parameters": "texts",
+        "summary": "texts",
+    },
+    TrendResult,
+    incremental=True,
+)
+
+# The Streamlit "Actionable Insights" view, which also asks for common feedback
+ACTIONABLE_INSIGHTS = Analysis(
+    "actionable_insights",
+    '''
+        You are a text to insight service. Peform analysis and retrieve actionable insights from the following. Generate atleast 5 actionable insights. Also find the most common requests, suggestions and criticisms. Also consider the custom parameters field:
+        data: {data},
+        custom parameters: {custom_para},
+        insight: {insight},
+        ''',
+    '''
+        Your output should be in the JSON format:
+                {
+        "actionable_insights": [
+           {"actionable insight":"phrase", "actionable insight":"phrase"}
+        ],
+        "common_requests": [
+        {"common request": "phrase", "common request": "phrase}
+        ],
+        "common_suggestions": [
+        {"common suggestion": "phrase", "common suggestion": "phrase}
+        ],
+        "common_criticisms": [
+        {"common criticisms": "phrase", "common criticisms": "phrase}
+        ],
+        "custom_parameters": "answer to the custom parameters",
+        "summary": "summary goes here"
+        }
+
+        ''',
+    {
+        "actionable_insights": "union",
+        "common_requests": "union",
+        "common_suggestions": "union",
+        "common_criticisms": "union",
+        "custom_parameters": "texts",
+        "summary": "texts",
+    },
+    ActionableInsightsResult,
+    incremental=True,
+)
+
+ANALYSES = {
+    analysis.name: analysis
+    for analysis in (SENTIMENT, ENTITY_RECOGNITION, TOPIC_MODELLING, TREND_ANALYSIS, ACTIONABLE_INSIGHTS)
+}
@@ -0,0 +1,255 @@
+import asyncio
+import glob
+import hashlib
+import os
+import tempfile
+from collections import Counter
+from itertools import islice
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from parable_core.cache import CACHE_DIR, cache_key
+from parable_core.chunking import CHARS_PER_TOKEN, estimate_tokens
+from parable_core.csv_prep import CsvPreparation
+from parable_core.ingestion import UnsupportedDocument, file_name, spool
+from parable_core.llm import MAX_CONCURRENCY, MODEL, TEMPERATURE, acomplete
+from parable_core.pipeline import parse_partial
+
+# Review text per request, and a cap on rows so the per-row answers fit in the
+# completion budget
+BATCH_TOKENS = int(os.getenv("PARABLE_BATCH_TOKENS", 1500))
+BATCH_ROWS = int(os.getenv("PARABLE_BATCH_ROWS", 25))
+# Rows per Parquet part; a part is written as soon as its batches are answered
+PART_ROWS = int(os.getenv("PARABLE_BATCH_PART_ROWS", 2000))
+BATCH_DIR = os.path.join(CACHE_DIR, "batches")
+
+SENTIMENTS = ("positive", "negative", "neutral")
+
+ROW_PROMPT = '''You are a text to insight service. Perform sentiment analysis on each of the following reviews separately.
+        Each review starts with its id in square brackets. Also consider the custom parameters field:
+        reviews: {data},
+        custom parameters: {custom_para},
+        insight: {insight},
+        '''
+ROW_OUTPUT = '''
+        Your output should be a JSON list with one object per review, in the same order:
+        [
+            {"id": review id, "sentiment": "positive, negative or neutral", "score": number between -1 and 1, "phrases": ["key phrases of the review"]}
+        ]
+        '''
+
+SCHEMA = pa.schema([
+    ("row", pa.int64()),
+    ("text", pa.string()),
+    ("sentiment", pa.string()),
+    ("score", pa.float64()),
+    ("phrases", pa.list_(pa.string())),
+    ("error", pa.string()),
+])
+
+
+def row_batches(rows, max_tokens=BATCH_TOKENS, max_rows=BATCH_ROWS):
+    # Group (row, text) pairs into batches under the token budget; a single
+    # review longer than the budget is truncated to it
+    batch, tokens = [], 0
+    for row, text in rows:
+        text = text[: max_tokens * CHARS_PER_TOKEN]
+        text_tokens = estimate_tokens(text)
+        if batch and (tokens + text_tokens > max_tokens or len(batch) >= max_rows):
+            yield batch
+            batch, tokens = [], 0
+        batch.append((row, text))
+        tokens += text_tokens
+    if batch:
+        yield batch
+
+
+def batch_prompt(batch, custom_para, insight):
+    data = "".join(f"\n[{row}] {text}" for row, text in batch)
+    return ROW_PROMPT.format(data=data, custom_para=custom_para, insight=insight) + ROW_OUTPUT
+
+
+def failed(row, text, error):
+    return {"row": row, "text": text, "sentiment": None, "score": None, "phrases": [], "error": error}
+
+
+def parse_rows(batch, response):
+    # Match the model's answers to the batch's rows by id; rows it left out
+    # are recorded as failed so a rerun retries them
+    answers = parse_partial(response)
+    if not isinstance(answers, list):
+        return [failed(row, text, "unparseable model output") for row, text in batch]
+    by_id = {}
+    for answer in answers:
+        try:
+            by_id[int(answer["id"])] = answer
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    records = []
+    for row, text in batch:
+        answer = by_id.get(row)
+        sentiment = str(answer.get("sentiment", "")).strip().lower() if answer else ""
+        if sentiment not in SENTIMENTS:
+            records.append(failed(row, text, "missing from model output"))
+            continue
+        try:
+            score = max(-1.0, min(1.0, float(answer.get("score"))))
+        except (TypeError, ValueError):
+            score = None
+        phrases = answer.get("phrases")
+        phrases = [str(p) for p in phrases] if isinstance(phrases, list) else []
+        records.append({
+            "row": row, "text": text, "sentiment": sentiment, "score": score, "phrases": phrases, "error": None,
+        })
+    return records
+
+
+async def analyse_batches(batches, custom_para, insight, concurrency=MAX_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+    responses = await asyncio.gather(
+        *(acomplete(batch_prompt(batch, custom_para, insight), semaphore) for batch in batches),
+        return_exceptions=True,
+    )
+    records = []
+    for batch, response in zip(batches, responses):
+        if isinstance(response, Exception):
+            records.extend(failed(row, text, str(response)) for row, text in batch)
+        else:
+            records.extend(parse_rows(batch, response))
+    return records
+
+
+def write_aside(path, write):
+    # `write(temporary)` then rename over `path`, so a crash never leaves half a
+    # file; the temporary name is unique, so concurrent runs never share one
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".")
+    os.close(fd)
+    try:
+        write(temporary)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+class BatchRun:
+    # Per-row sentiment for a CSV of reviews. Rows are grouped into
+    # token-budgeted batches sent concurrently, and the answers are written to
+    # a directory of Parquet parts as each part's rows come back, so memory
+    # stays bounded and a crash loses at most one part. Rerunning the same
+    # upload with the same parameters keeps the finished parts and only
+    # retries the rows that failed.
+
+    def __init__(self, file, custom_para, insight, columns=None):
+        if not file_name(file).lower().endswith(".csv"):
+            raise UnsupportedDocument("Batch analysis needs a .csv upload")
+        self.file = spool(file)
+        self.custom_para = custom_para
+        self.insight = insight
+        self.columns = columns
+        upload = hashlib.sha256(self.file.getbuffer()).hexdigest()
+        self.id = cache_key(
+            "sentiment_batch", custom_para, insight, columns, MODEL, TEMPERATURE, BATCH_TOKENS, BATCH_ROWS,
+            PART_ROWS, upload,
+        )
+        self.path = os.path.join(BATCH_DIR, self.id)
+        self.report = {}
+
+    @property
+    def results_path(self):
+        return results_path(self.id)
+
+    def parts(self):
+        rows = CsvPreparation(self.file, columns=self.columns, max_rows=0, report=self.report).rows() or iter(())
+        while True:
+            part = list(islice(rows, PART_ROWS))
+            if not part:
+                return
+            yield part
+
+    def run(self, progress=None):
+        # `progress(rows_done)` is called after each part is written
+        os.makedirs(self.path, exist_ok=True)
+        done = 0
+        for n, rows in enumerate(self.parts()):
+            path = os.path.join(self.path, f"part-{n:05d}.parquet")
+            kept, pending = [], rows
+            if os.path.exists(path):
+                kept = [r for r in pq.read_table(path).to_pylist() if r["error"] is None]
+                finished = {r["row"] for r in kept}
+                pending = [(row, text) for row, text in rows if row not in finished]
+            if pending:
+                records = kept + asyncio.run(
+                    analyse_batches(list(row_batches(pending)), self.custom_para, self.insight)
+                )
+                records.sort(key=lambda r: r["row"])
+                write_aside(path, lambda temporary: pq.write_table(
+                    pa.Table.from_pylist(records, schema=SCHEMA), temporary
+                ))
+            done += len(rows)
+            if progress:
+                progress(done)
+        self.report["included"] = done
+        return self.combine()
+
+    def combine(self):
+        # Stream the parts into one results file and aggregate on the way
+        counts, phrases = Counter(), {s: Counter() for s in SENTIMENTS}
+        rows = failures = scored = 0
+        score_total = 0.0
+
+        def write(temporary):
+            nonlocal rows, failures, scored, score_total
+            with pq.ParquetWriter(temporary, SCHEMA) as writer:
+                for path in sorted(glob.glob(os.path.join(self.path, "part-*.parquet"))):
+                    table = pq.read_table(path)
+                    writer.write_table(table)
+                    frame = table.to_pandas()
+                    rows += len(frame)
+                    failures += int(frame["error"].notna().sum())
+                    counts.update(frame["sentiment"].dropna())
+                    scored += int(frame["score"].notna().sum())
+                    score_total += float(frame["score"].sum())
+                    for sentiment, row_phrases in zip(frame["sentiment"], frame["phrases"]):
+                        if sentiment in phrases:
+                            phrases[sentiment].update(p.lower() for p in row_phrases)
+
+        write_aside(self.results_path, write)
+
+        analysed = rows - failures
+        return {
+            "id": self.id,
+            "aggregates": {
+                "rows": rows,
+                "analysed": analysed,
+                "failed": failures,
+                "sentiment_counts": {s: counts[s] for s in SENTIMENTS},
+                "sentiment_share": {s: round(counts[s] / analysed, 4) if analysed else 0 for s in SENTIMENTS},
+                "mean_score": round(score_total / scored, 4) if scored else None,
+                "top_phrases": {s: dict(phrases[s].most_common(20)) for s in SENTIMENTS},
+            },
+            "document": self.report,
+        }
+
+
+def results_path(batch_id):
+    return os.path.join(BATCH_DIR, f"{batch_id}.parquet")
+
+
+def read_rows(batch_id, offset=0, limit=100):
+    # A page of the per-row results table, read one record batch at a time
+    path = results_path(batch_id)
+    if not os.path.exists(path):
+        return None
+    rows = []
+    for record_batch in pq.ParquetFile(path).iter_batches(batch_size=max(limit, 1)):
+        if offset >= record_batch.num_rows:
+            offset -= record_batch.num_rows
+            continue
+        rows.extend(record_batch.slice(offset).to_pylist())
+        offset = 0
+        if len(rows) >= limit:
+            break
+    return rows[:limit]
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from cachetools import LRUCache
+
+from parable_core.metrics import registry
+
+CACHE_DIR = os.getenv("PARABLE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "parable"))
+# In-process tier, counted in entries
+MEMORY_ENTRIES = int(os.getenv("PARABLE_CACHE_ENTRIES", 256))
+# On-disk tier, counted in bytes of cached responses
+DISK_BYTES = int(os.getenv("PARABLE_CACHE_DISK_BYTES", 256 * 1024 * 1024))
+
+
+def normalise_text(text):
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(*parts, text=""):
+    # Content address over the normalised document and everything that shapes the answer
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(p) for p in parts]).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalise_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    # Two tiers: an LRU dict in front of a SQLite table that is trimmed back
+    # under `disk_bytes` by least-recent access whenever it grows past it.
+
+    def __init__(self, path, memory_entries=MEMORY_ENTRIES, disk_bytes=DISK_BYTES):
+        self.path = path
+        self.disk_bytes = disk_bytes
+        self.memory = LRUCache(maxsize=memory_entries)
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)"
+            )
+            self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.stats["memory_hits"] += 1
+                return self.memory[key]
+            if self.db is not None:
+                row = self.db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                    self.db.commit()
+                    self.memory[key] = row[0]
+                    self.stats["disk_hits"] += 1
+                    return row[0]
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+            if self.db is None:
+                return
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), time.time()),
+            )
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.disk_bytes:
+            return
+        rows = self.db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if total <= self.disk_bytes:
+                break
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.memory.pop(key, None)
+            total -= size
+            self.stats["evictions"] += 1
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def hit_rate(self):
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+
+response_cache = ResponseCache(os.path.join(CACHE_DIR, "responses.sqlite3"))
+# Per-chunk map results of incremental analyses, see pipeline.map_chunks
+partial_cache = ResponseCache(os.path.join(CACHE_DIR, "partials.sqlite3"))
+registry.watch_cache("responses", response_cache)
+registry.watch_cache("partials", partial_cache)
@@ -0,0 +1,170 @@
+import hashlib
+import re
+from collections import namedtuple
+
+# gpt-3.5-turbo averages roughly four characters of English per token. We only
+# need a conservative budget, not an exact count, so avoid shipping a tokenizer.
+CHARS_PER_TOKEN = 4
+
+# Leaves room in the 4k context for the instructions, the JSON output format
+# and the model's answer.
+CHUNK_TOKENS = 2000
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def split_oversized(piece, max_tokens):
+    # A single page or row bigger than the budget is cut on whitespace
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    words = re.split(r"(\s+)", piece)
+    current = ""
+    for word in words:
+        if current and len(current) + len(word) > max_chars:
+            yield current
+            current = ""
+        while len(word) > max_chars:
+            yield word[:max_chars]
+            word = word[max_chars:]
+        current += word
+    if current.strip():
+        yield current
+
+
+def chunk_pieces(pieces, max_tokens=CHUNK_TOKENS):
+    # Pack consecutive pieces (pages, paragraphs, rows) into chunks under the token budget
+    current, current_tokens = [], 0
+    for piece in pieces:
+        piece_tokens = estimate_tokens(piece)
+        if piece_tokens > max_tokens:
+            if current:
+                yield "\n".join(current)
+                current, current_tokens = [], 0
+            yield from split_oversized(piece, max_tokens)
+            continue
+        if current and current_tokens + piece_tokens > max_tokens:
+            yield "\n".join(current)
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        yield "\n".join(current)
+
+
+def chunk_text(text, max_tokens=CHUNK_TOKENS):
+    return chunk_pieces(text.split("\n"), max_tokens)
+
+
+def is_boundary(piece, probability):
+    # Deterministic in the piece's content, true with the given probability
+    value = int.from_bytes(hashlib.blake2b(piece.encode("utf-8"), digest_size=8).digest(), "big")
+    return value < min(probability, 1) * 2 ** 64
+
+
+def content_defined_chunks(pieces, max_tokens=CHUNK_TOKENS):
+    # Like chunk_pieces, but a chunk also ends after any piece whose hash
+    # marks a boundary, so boundaries follow the content rather than the
+    # position. Inserting or appending records then only changes the chunks
+    # around the edit, and every other chunk comes out byte for byte the same
+    # as on the previous run. Chunks average about half the budget.
+    target = max_tokens // 2
+    current, current_tokens = [], 0
+    for piece in pieces:
+        piece_tokens = estimate_tokens(piece)
+        if piece_tokens > max_tokens:
+            if current:
+                yield "\n".join(current)
+                current, current_tokens = [], 0
+            yield from split_oversized(piece, max_tokens)
+            continue
+        if current and current_tokens + piece_tokens > max_tokens:
+            yield "\n".join(current)
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += piece_tokens
+        if current_tokens >= target // 4 and is_boundary(piece, piece_tokens / target):
+            yield "\n".join(current)
+            current, current_tokens = [], 0
+    if current:
+        yield "\n".join(current)
+
+
+# Sentence ends followed by whitespace, and blank lines between paragraphs
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])[\"')\]]*\s+|\n\s*\n")
+
+Span = namedtuple("Span", "page start end tokens closes_paragraph text")
+
+
+def iter_sentences(text):
+    # (start, end, closes_paragraph) for each sentence in `text`
+    start = 0
+    for match in SENTENCE_BREAK.finditer(text):
+        if text[start:match.start()].strip():
+            yield start, match.start(), match.group().count("\n") > 1
+        start = match.end()
+    if text[start:].strip():
+        yield start, len(text.rstrip()), True
+
+
+def iter_spans(pages, max_tokens):
+    # Sentences as Spans; a sentence over the budget is cut on whitespace so
+    # that every span fits in one chunk
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    for page, text in pages:
+        for start, end, closes_paragraph in iter_sentences(text):
+            while end - start > max_chars:
+                cut = text.rfind(" ", start, start + max_chars)
+                cut = cut if cut > start else start + max_chars
+                yield Span(page, start, cut, estimate_tokens(text[start:cut]), False, text[start:cut])
+                start = cut
+                while start < end and text[start].isspace():
+                    start += 1
+            piece = text[start:end]
+            yield Span(page, start, end, estimate_tokens(piece), closes_paragraph, piece)
+
+
+def chunk_pages(pages, max_tokens=256, overlap_tokens=32):
+    # Stream (text, provenance) chunks out of (page_number, page_text) pairs.
+    # Chunks end on sentence boundaries, at a paragraph end once they are at
+    # least half full, and repeat the last `overlap_tokens` worth of sentences
+    # of the previous chunk. Provenance is the page and in-page character
+    # offset of the first and last sentence.
+    window, window_tokens, fresh = [], 0, 0
+
+    def emit():
+        first, last = window[0], window[-1]
+        text = " ".join(span.text.strip() for span in window)
+        return text, {
+            "page": first.page,
+            "start_char": first.start,
+            "end_page": last.page,
+            "end_char": last.end,
+        }
+
+    def overlap():
+        kept, kept_tokens = [], 0
+        for span in reversed(window):
+            if kept_tokens + span.tokens > overlap_tokens:
+                break
+            kept.insert(0, span)
+            kept_tokens += span.tokens
+        return kept, kept_tokens
+
+    for span in iter_spans(pages, max_tokens):
+        if fresh and window_tokens + span.tokens > max_tokens:
+            yield emit()
+            window, window_tokens = overlap()
+            fresh = 0
+            # The overlap has to leave room for the sentence that did not fit
+            while window and window_tokens + span.tokens > max_tokens:
+                window_tokens -= window.pop(0).tokens
+        window.append(span)
+        window_tokens += span.tokens
+        fresh += 1
+        if span.closes_paragraph and window_tokens >= max_tokens // 2:
+            yield emit()
+            window, window_tokens = overlap()
+            fresh = 0
+    if fresh:
+        yield emit()
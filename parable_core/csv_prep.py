@@ -0,0 +1,152 @@
+import codecs
+import csv
+import hashlib
+import heapq
+import os
+import re
+
+# Rows looked at before deciding which columns carry the text
+SAMPLE_ROWS = 200
+# Columns averaging fewer characters than this are treated as metadata (ids,
+# ratings, flags) rather than text, as long as at least one longer column exists
+TEXT_MIN_CHARS = 15
+# 0 keeps every row; otherwise a uniform sample of this many rows is sent
+MAX_ROWS = int(os.getenv("PARABLE_CSV_MAX_ROWS", 0))
+# The last line CsvPreparation adds, so consumers of the text can tell rows from it
+SUMMARY_LINE = re.compile(r"^\[\d+ rows read, \d+ duplicates and \d+ empty rows dropped, \d+ rows included.*\]$")
+
+
+def is_number(value):
+    try:
+        float(value.replace(",", ""))
+        return True
+    except ValueError:
+        return False
+
+
+def pick_text_columns(header, rows):
+    candidates = []
+    for i, column in enumerate(header):
+        column = column.strip()
+        # pandas writes its index as an unnamed first column
+        if not column or column.lower().startswith("unnamed:"):
+            continue
+        values = [row[i].strip() for row in rows if i < len(row) and row[i].strip()]
+        if not values or sum(map(is_number, values)) > 0.8 * len(values):
+            continue
+        candidates.append((sum(map(len, values)) / len(values), i))
+
+    long_columns = [i for length, i in candidates if length >= TEXT_MIN_CHARS]
+    return long_columns or [i for _, i in candidates] or list(range(len(header)))
+
+
+def fingerprint(text):
+    # Rows differing only in case, punctuation or spacing count as duplicates
+    normalised = re.sub(r"[\W_]+", " ", text.lower()).strip()
+    return hashlib.blake2b(normalised.encode("utf-8"), digest_size=8).digest()
+
+
+def compact(value):
+    return re.sub(r"\s+", " ", value).strip().replace("|", "/")
+
+
+class CsvPreparation:
+    # Turns a CSV upload into one compact line per record: only the text
+    # columns, separated by " | ", with duplicates dropped. `report` is filled
+    # in while iterating and summarised on the last line for the model.
+
+    def __init__(self, file, columns=None, max_rows=MAX_ROWS, report=None):
+        self.file = file
+        self.columns = columns
+        self.max_rows = max_rows
+        self.report = report if report is not None else {}
+        self.report.update({
+            "rows": 0,
+            "empty": 0,
+            "duplicates": 0,
+            "included": 0,
+            "sampled": False,
+            "columns": [],
+        })
+
+    def __iter__(self):
+        records = self.rows()
+        if records is None:
+            return
+        records = (record for _, record in records)
+        if self.max_rows:
+            records = self.reservoir(records)
+
+        yield " | ".join(self.report["columns"])
+        for record in records:
+            self.report["included"] += 1
+            yield record
+        yield self.summary()
+
+    def rows(self):
+        # (row number, record) for every kept row, or None for an empty file
+        # utf-8-sig drops the byte order mark Excel puts before the first column name
+        reader = csv.reader(codecs.iterdecode(self.file, "utf-8-sig", errors="replace"))
+        header = next(reader, None)
+        if header is None:
+            return None
+
+        sample = []
+        for row in reader:
+            sample.append(row)
+            if len(sample) >= SAMPLE_ROWS:
+                break
+        if self.columns:
+            names = [column.strip() for column in header]
+            indexes = [names.index(c.strip()) for c in self.columns if c.strip() in names]
+            if not indexes:
+                # ingestion imports this module, so its errors are imported here
+                from parable_core.ingestion import DocumentError
+                raise DocumentError(
+                    f"None of the columns {', '.join(self.columns)} are in the CSV header: {', '.join(names)}"
+                )
+        else:
+            indexes = pick_text_columns(header, sample)
+        self.report["columns"] = [header[i].strip() for i in indexes]
+        return self.records(indexes, sample, reader)
+
+    def records(self, indexes, sample, reader):
+        seen = set()
+        for rows in (sample, reader):
+            for row in rows:
+                self.report["rows"] += 1
+                record = " | ".join(compact(row[i]) if i < len(row) else "" for i in indexes)
+                if not record.replace("|", "").strip():
+                    self.report["empty"] += 1
+                    continue
+                key = fingerprint(record)
+                if key in seen:
+                    self.report["duplicates"] += 1
+                    continue
+                seen.add(key)
+                yield self.report["rows"], record
+
+    def reservoir(self, records):
+        # Uniform sample of max_rows records, emitted in their original order.
+        # Records are ranked by their content hash instead of random draws, so
+        # the same upload always gives the same sample and the same cache key.
+        kept = []
+        for n, record in enumerate(records):
+            item = (-int.from_bytes(fingerprint(record), "big"), n, record)
+            if n < self.max_rows:
+                heapq.heappush(kept, item)
+            else:
+                self.report["sampled"] = True
+                heapq.heappushpop(kept, item)
+        for _, _, record in sorted(kept, key=lambda item: item[1]):
+            yield record
+
+    def summary(self):
+        report = self.report
+        line = (
+            f"[{report['rows']} rows read, {report['duplicates']} duplicates and "
+            f"{report['empty']} empty rows dropped, {report['included']} rows included"
+        )
+        if report["sampled"]:
+            line += " as a uniform sample"
+        return line + "]"
@@ -0,0 +1,108 @@
+import codecs
+import io
+import os
+import zipfile
+from xml.etree import ElementTree
+
+import PyPDF2
+
+from parable_core.csv_prep import CsvPreparation
+from parable_core.metrics import span
+
+# Ceiling on how much extracted text a single upload may produce. Extraction
+# stops as soon as it is crossed instead of reading the rest of the file.
+MAX_DOCUMENT_CHARS = int(os.getenv("PARABLE_MAX_DOCUMENT_CHARS", 2_000_000))
+
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+class DocumentError(ValueError):
+    status_code = 400
+
+
+class UnsupportedDocument(DocumentError):
+    status_code = 415
+
+
+class DocumentTooLarge(DocumentError):
+    status_code = 413
+
+
+def file_name(file):
+    # Flask's FileStorage has .filename, Streamlit's UploadedFile has .name
+    return (getattr(file, "filename", None) or getattr(file, "name", None) or "").lower()
+
+
+def spool(file):
+    # Copy an upload into memory so it can be read after the request has finished
+    copy = io.BytesIO(file.read())
+    copy.name = file_name(file)
+    return copy
+
+
+def iter_pdf_pages(file):
+    # Pages are parsed lazily by PyPDF2, so only one page's text is alive at a time
+    pdf_reader = PyPDF2.PdfReader(file)
+    for page in pdf_reader.pages:
+        yield page.extract_text() or ""
+
+
+def iter_doc_paragraphs(file):
+    # Stream <w:p> elements out of word/document.xml rather than materialising the tree
+    try:
+        archive = zipfile.ZipFile(file)
+    except zipfile.BadZipFile:
+        raise UnsupportedDocument("Only .docx Word documents can be read")
+    with archive:
+        with archive.open("word/document.xml") as document:
+            parts = []
+            for event, element in ElementTree.iterparse(document, events=("end",)):
+                if element.tag == WORD_NS + "t":
+                    parts.append(element.text or "")
+                elif element.tag == WORD_NS + "tab":
+                    parts.append("\t")
+                elif element.tag in (WORD_NS + "br", WORD_NS + "cr"):
+                    parts.append("\n")
+                elif element.tag == WORD_NS + "p":
+                    paragraph = "".join(parts).strip()
+                    parts = []
+                    element.clear()
+                    if paragraph:
+                        yield paragraph
+
+
+def iter_text_lines(file):
+    for line in codecs.iterdecode(file, "utf-8", errors="replace"):
+        line = line.rstrip("\r\n")
+        if line.strip():
+            yield line
+
+
+def iter_document(file, max_chars=MAX_DOCUMENT_CHARS, report=None):
+    # Yield the text of an uploaded file piece by piece (page, paragraph or row).
+    # For CSVs, `report` is filled with the row counts from CsvPreparation.
+    name = file_name(file)
+    if name.endswith(".pdf"):
+        pieces = iter_pdf_pages(file)
+    elif name.endswith(".docx") or name.endswith(".doc"):
+        pieces = iter_doc_paragraphs(file)
+    elif name.endswith(".csv"):
+        pieces = CsvPreparation(file, report=report)
+    elif name.endswith(".txt"):
+        pieces = iter_text_lines(file)
+    else:
+        raise UnsupportedDocument(f"Unsupported file type: {name or 'unknown'}")
+
+    total = 0
+    for piece in pieces:
+        total += len(piece)
+        if max_chars and total > max_chars:
+            raise DocumentTooLarge(
+                f"{name} exceeds the {max_chars} character limit for a single document"
+            )
+        yield piece
+
+
+def read_document(file, max_chars=MAX_DOCUMENT_CHARS, report=None):
+    with span("extraction"):
+        return "\n".join(iter_document(file, max_chars=max_chars, report=report))
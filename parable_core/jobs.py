@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from parable_core.cache import CACHE_DIR
+from parable_core.ingestion import read_document
+from parable_core.pipeline import run_analyses
+from parable_core.scraper import scrape_reviews
+
+JOB_WORKERS = int(os.getenv("PARABLE_JOB_WORKERS", 4))
+# Finished jobs are kept this long for clients to collect their results
+JOB_TTL_SECONDS = int(os.getenv("PARABLE_JOB_TTL_SECONDS", 24 * 60 * 60))
+
+
+class JobStore:
+    # Job state in SQLite so every process serving the app sees the same jobs,
+    # without needing an external broker.
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, analyses TEXT, "
+            "progress TEXT, result TEXT, error TEXT, created REAL, updated REAL, engine TEXT)"
+        )
+        # Job stores created before jobs recorded their engine
+        if "engine" not in {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN engine TEXT")
+        self.db.commit()
+
+    def create(self, analyses, engine=None):
+        job_id = uuid.uuid4().hex
+        progress = {name: {"done": 0, "total": None} for name in analyses}
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (id, status, analyses, progress, created, updated, engine) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(analyses), json.dumps(progress), now, now, engine),
+            )
+            self.db.execute("DELETE FROM jobs WHERE updated < ?", (now - JOB_TTL_SECONDS,))
+            self.db.commit()
+        return job_id
+
+    def update(self, job_id, **fields):
+        fields = {k: json.dumps(v) if k in ("progress", "result") else v for k, v in fields.items()}
+        fields["updated"] = time.time()
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self.lock:
+            self.db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            self.db.commit()
+
+    def set_progress(self, job_id, name, done, total):
+        with self.lock:
+            row = self.db.execute("SELECT progress FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            progress = json.loads(row[0])
+            progress[name] = {"done": done, "total": total}
+            self.db.execute(
+                "UPDATE jobs SET progress = ?, updated = ? WHERE id = ?",
+                (json.dumps(progress), time.time(), job_id),
+            )
+            self.db.commit()
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, status, analyses, progress, result, error, created, updated, engine "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "analyses": json.loads(row[2]),
+            "progress": json.loads(row[3]),
+            "result": json.loads(row[4]) if row[4] else None,
+            "error": row[5],
+            "created": row[6],
+            "updated": row[7],
+            "engine": row[8],
+        }
+
+
+store = JobStore(os.path.join(CACHE_DIR, "jobs.sqlite3"))
+pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="parable-job")
+
+
+def run_job(job_id, file, names, custom_para, insight, engine=None):
+    store.update(job_id, status="running")
+    try:
+        data = read_document(file)
+        result, errors = {}, {}
+        for name, response, error in run_analyses(
+            names, data, custom_para, insight,
+            progress=lambda name, done, total: store.set_progress(job_id, name, done, total), engine=engine,
+        ):
+            result[name] = response
+            if error:
+                errors[name] = error
+            elif store.get(job_id)["progress"][name]["total"] is None:
+                # Cache hits finish without reporting any chunk progress
+                store.set_progress(job_id, name, 1, 1)
+        if errors:
+            store.update(job_id, status="failed", result=result, error=json.dumps(errors))
+        else:
+            store.update(job_id, status="finished", result=result)
+    except Exception as error:
+        store.update(job_id, status="failed", error=str(error))
+
+
+def submit(file, names, custom_para, insight, engine=None):
+    # `file` must already be spooled, the request that uploaded it will be gone
+    job_id = store.create(names, engine)
+    pool.submit(run_job, job_id, file, names, custom_para, insight, engine)
+    return job_id
+
+
+def run_batch(job_id, batch):
+    store.update(job_id, status="running")
+    try:
+        result = batch.run(progress=lambda done: store.set_progress(job_id, "sentiment_batch", done, None))
+        rows = result["aggregates"]["rows"]
+        store.set_progress(job_id, "sentiment_batch", rows, rows)
+        store.update(job_id, status="finished", result=result)
+    except Exception as error:
+        store.update(job_id, status="failed", error=str(error))
+
+
+def submit_batch(batch):
+    # `batch` is a BatchRun, which spools its upload when created
+    job_id = store.create(["sentiment_batch"])
+    pool.submit(run_batch, job_id, batch)
+    return job_id
+
+
+def run_scrape(job_id, urls, collection, max_pages):
+    store.update(job_id, status="running")
+    try:
+        result = scrape_reviews(urls, collection, max_pages)
+        store.set_progress(job_id, "scrape", result["pages"], result["pages"])
+        store.update(job_id, status="failed" if result["errors"] else "finished", result=result,
+                     error=json.dumps(result["errors"]) if result["errors"] else None)
+    except Exception as error:
+        store.update(job_id, status="failed", error=str(error))
+
+
+def submit_scrape(urls, collection, max_pages):
+    job_id = store.create(["scrape"])
+    pool.submit(run_scrape, job_id, urls, collection, max_pages)
+    return job_id
@@ -0,0 +1,222 @@
+import asyncio
+import os
+import threading
+import time
+
+import aiohttp
+import openai
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from parable_core.chunking import CHARS_PER_TOKEN, estimate_tokens
+from parable_core.metrics import record_request, record_usage, span
+
+MODEL = "gpt-3.5-turbo"
+TEMPERATURE = 0.6
+
+# Account limits for the model; the defaults are the gpt-3.5-turbo pay-as-you-go tier
+REQUESTS_PER_MINUTE = int(os.getenv("PARABLE_OPENAI_RPM", 3500))
+TOKENS_PER_MINUTE = int(os.getenv("PARABLE_OPENAI_TPM", 90000))
+# Upper bound on chunk requests in flight for a single document
+MAX_CONCURRENCY = int(os.getenv("PARABLE_OPENAI_CONCURRENCY", 8))
+# Reserved per request on top of the prompt for the model's answer
+COMPLETION_TOKENS = 1000
+# Connections the async server keeps open to the API, shared by all requests
+POOL_SIZE = int(os.getenv("PARABLE_OPENAI_POOL_SIZE", 100))
+KEEPALIVE_SECONDS = 60
+
+RETRYABLE = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+)
+RETRY_POLICY = dict(
+    retry=retry_if_exception_type(RETRYABLE),
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+
+class RateLimiter:
+    # Token bucket over requests and tokens per minute. State is guarded by a
+    # thread lock rather than an asyncio primitive so one limiter can be shared
+    # by every Flask worker thread and the event loops they start.
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = dict(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        # Take capacity for one request if available, otherwise return how long to wait
+        tokens = min(tokens, self.capacity["tokens"])
+        with self.lock:
+            now = time.monotonic()
+            elapsed, self.updated = now - self.updated, now
+            for kind, capacity in self.capacity.items():
+                self.available[kind] = min(capacity, self.available[kind] + capacity * elapsed / 60)
+
+            if self.available["requests"] >= 1 and self.available["tokens"] >= tokens:
+                self.available["requests"] -= 1
+                self.available["tokens"] -= tokens
+                return 0
+            return max(
+                (1 - self.available["requests"]) * 60 / self.capacity["requests"],
+                (tokens - self.available["tokens"]) * 60 / self.capacity["tokens"],
+            )
+
+    def refund(self, tokens):
+        # Return reserved tokens a request turned out not to need
+        with self.lock:
+            self.available["tokens"] = min(self.capacity["tokens"], self.available["tokens"] + max(tokens, 0))
+
+    async def acquire(self, tokens):
+        while True:
+            wait = self.reserve(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens):
+        while True:
+            wait = self.reserve(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+
+def open_session():
+    # A pooled keep-alive session for the async API calls of one event loop.
+    # openai uses it wherever it is set as openai.aiosession, instead of
+    # opening a session (and a TLS connection) per request.
+    connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_SECONDS, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector)
+
+
+def request_tokens(prompt):
+    return estimate_tokens(prompt) + COMPLETION_TOKENS
+
+
+def settle(prompt, usage):
+    # Each request reserves the whole completion budget up front; once the
+    # answer is in, the part of it that went unused is handed back
+    if usage and usage.get("total_tokens") is not None:
+        reserved = min(request_tokens(prompt), limiter.capacity["tokens"])
+        limiter.refund(reserved - usage["total_tokens"])
+
+
+@retry(**RETRY_POLICY)
+def complete(prompt):
+    # Send prompt to OpenAI and get output
+    limiter.acquire_sync(request_tokens(prompt))
+    with span("llm_call"):
+        try:
+            response = openai.ChatCompletion.create(
+                model=MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=TEMPERATURE,
+            )
+        except Exception:
+            record_request(MODEL, "error")
+            raise
+    record_request(MODEL, "ok")
+    record_usage(response.get("usage"), MODEL)
+    settle(prompt, response.get("usage"))
+    return response.choices[0].message.content
+
+
+def stream(prompt):
+    # Yield the answer's text deltas as the model produces them
+    with span("llm_call"):
+        for attempt in Retrying(**RETRY_POLICY):
+            with attempt:
+                # Every attempt is a request of its own, retries included
+                limiter.acquire_sync(request_tokens(prompt))
+                try:
+                    response = openai.ChatCompletion.create(
+                        model=MODEL,
+                        messages=[{"role": "user", "content": prompt}],
+                        temperature=TEMPERATURE,
+                        stream=True,
+                    )
+                except Exception:
+                    record_request(MODEL, "error")
+                    raise
+        record_request(MODEL, "ok")
+        completion = 0
+        for chunk in response:
+            delta = chunk.choices[0].delta.get("content")
+            if delta:
+                completion += len(delta)
+                yield delta
+    # Streamed responses carry no usage, so these counts are estimates
+    usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": completion // CHARS_PER_TOKEN}
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    record_usage(usage, MODEL)
+    settle(prompt, usage)
+
+
+async def acreate(prompt):
+    with span("llm_call"):
+        try:
+            response = await openai.ChatCompletion.acreate(
+                model=MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=TEMPERATURE,
+            )
+        except Exception:
+            record_request(MODEL, "error")
+            raise
+    record_request(MODEL, "ok")
+    record_usage(response.get("usage"), MODEL)
+    settle(prompt, response.get("usage"))
+    return response.choices[0].message.content
+
+
+async def acomplete(prompt, semaphore=None):
+    async for attempt in AsyncRetrying(**RETRY_POLICY):
+        with attempt:
+            await limiter.acquire(request_tokens(prompt))
+            if semaphore is None:
+                return await acreate(prompt)
+            async with semaphore:
+                return await acreate(prompt)
+
+
+async def acomplete_all(prompts, concurrency=MAX_CONCURRENCY, progress=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+
+    async def run(prompt):
+        nonlocal done
+        result = await acomplete(prompt, semaphore)
+        done += 1
+        if progress:
+            progress(done, len(prompts))
+        return result
+
+    return await asyncio.gather(*(run(prompt) for prompt in prompts))
+
+
+def complete_all(prompts, concurrency=MAX_CONCURRENCY, progress=None):
+    # Fan the prompts out concurrently; results come back in prompt order.
+    # `progress(done, total)` is called as each prompt completes.
+    if len(prompts) == 1:
+        results = [complete(prompts[0])]
+        if progress:
+            progress(1, 1)
+        return results
+    return asyncio.run(acomplete_all(prompts, concurrency, progress))
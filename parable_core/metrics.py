@@ -0,0 +1,149 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Log one JSON line per request with its spans and token counts
+STRUCTURED_LOGS = os.getenv("PARABLE_METRICS_LOG", "") == "1"
+# Upper bounds in seconds; an LLM round trip is typically seconds, extraction milliseconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+logger = logging.getLogger("parable.metrics")
+if STRUCTURED_LOGS and not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    # Stage histograms and counters kept in process memory, rendered in the
+    # Prometheus text format. One lock, held only for a few additions per
+    # observation, so instrumentation can stay on in production.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.caches = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def watch_cache(self, name, cache):
+        # `cache` needs a `stats` dict and `hit_rate()`, read at scrape time
+        self.caches[name] = cache
+
+    def render(self):
+        lines = [
+            "# HELP parable_stage_seconds Time spent in each pipeline stage",
+            "# TYPE parable_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'parable_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'parable_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'parable_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            counters = sorted(self.counters.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            rendered = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{name}{{{rendered}}} {value}")
+
+        lines.append("# TYPE parable_cache_events_total counter")
+        for name, cache in sorted(self.caches.items()):
+            for event, value in sorted(cache.stats.items()):
+                lines.append(f'parable_cache_events_total{{cache="{name}",event="{event}"}} {value}')
+        lines.append("# TYPE parable_cache_hit_ratio gauge")
+        for name, cache in sorted(self.caches.items()):
+            lines.append(f'parable_cache_hit_ratio{{cache="{name}"}} {cache.hit_rate()}')
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# The trace of the request being served, if any: {"spans": [...], "tokens": {...}}
+current_trace = contextvars.ContextVar("parable_trace", default=None)
+
+
+@contextmanager
+def span(stage):
+    # Time a block as one pipeline stage: upload_read, extraction,
+    # prompt_build, llm_call or response_parse
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        registry.observe(stage, seconds)
+        trace = current_trace.get()
+        if trace is not None:
+            trace["spans"].append({"stage": stage, "seconds": round(seconds, 6)})
+
+
+def record_usage(usage, model):
+    # Token counts from an OpenAI response's `usage`
+    if not usage:
+        return
+    trace = current_trace.get()
+    for kind in ("prompt_tokens", "completion_tokens"):
+        tokens = usage.get(kind, 0) or 0
+        registry.increment("parable_llm_tokens_total", {"kind": kind.split("_")[0], "model": model}, tokens)
+        if trace is not None:
+            trace["tokens"][kind] = trace["tokens"].get(kind, 0) + tokens
+
+
+def record_request(model, outcome):
+    registry.increment("parable_llm_requests_total", {"model": model, "outcome": outcome})
+
+
+def start_trace(name):
+    trace = {"name": name, "start": time.perf_counter(), "spans": [], "tokens": {}}
+    return current_trace.set(trace)
+
+
+def finish_trace(token, status=None):
+    trace = current_trace.get()
+    current_trace.reset(token)
+    if trace is None:
+        return
+    seconds = time.perf_counter() - trace.pop("start")
+    registry.observe("request", seconds)
+    registry.increment("parable_requests_total", {"route": trace["name"], "status": status})
+    if STRUCTURED_LOGS:
+        logger.info(json.dumps({**trace, "status": status, "seconds": round(seconds, 6)}))
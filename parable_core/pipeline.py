@@ -0,0 +1,294 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from parable_core.analyses import ANALYSES
+from parable_core.cache import cache_key, partial_cache, response_cache
+from parable_core.chunking import CHUNK_TOKENS, chunk_text, content_defined_chunks
+from parable_core.llm import MODEL, TEMPERATURE, acomplete, acomplete_all, complete, complete_all, stream
+from parable_core.metrics import span
+from parable_core.schemas import repair_json
+from parable_core.textstats import digest, enrich
+from parable_core.topics import alocal_topic_modelling, local_topic_modelling
+
+# Budget for the merged partial results sent with the reduce prompt
+REDUCE_TOKENS = 2000
+# Documents of at least this many chunks are analysed from a local digest
+# instead of chunk by chunk: one model call instead of one per chunk, but the
+# model only sees statistics and sampled excerpts, so results are coarser.
+# 0, the default, always map-reduces.
+DIGEST_MIN_CHUNKS = int(os.getenv("PARABLE_DIGEST_MIN_CHUNKS", 0))
+# "local" models topics with NMF on this machine and uses the LLM only to
+# label them; "llm" asks the model for the whole topic analysis
+TOPIC_ENGINE = os.getenv("PARABLE_TOPIC_ENGINE", "llm")
+LOCAL_ENGINES = {"topic_modelling": local_topic_modelling}
+ALOCAL_ENGINES = {"topic_modelling": alocal_topic_modelling}
+
+
+def parse_partial(text):
+    return repair_json(text)
+
+
+def complete_partials(prompts, progress=None):
+    # Map answers, sending once more only the prompts whose answers could not
+    # be repaired into JSON
+    answers = complete_all(prompts, progress=progress)
+    invalid = [i for i, answer in enumerate(answers) if parse_partial(answer) is None]
+    if invalid:
+        for i, answer in zip(invalid, complete_all([prompts[i] for i in invalid])):
+            answers[i] = answer
+    return answers
+
+
+async def acomplete_partials(prompts):
+    answers = await acomplete_all(prompts)
+    invalid = [i for i, answer in enumerate(answers) if parse_partial(answer) is None]
+    if invalid:
+        for i, answer in zip(invalid, await acomplete_all([prompts[i] for i in invalid])):
+            answers[i] = answer
+    return answers
+
+
+def run_analysis(name, data, custom_para, insight, max_tokens=CHUNK_TOKENS, progress=None, engine=None):
+    # Identical uploads with identical parameters are answered from the cache
+    engine = engine_for(name, engine)
+    key = analysis_key(name, data, custom_para, insight, max_tokens, engine)
+    return response_cache.get_or_compute(
+        key, lambda: analyse(name, data, custom_para, insight, max_tokens, progress, engine)
+    )
+
+
+def engine_for(name, engine=None):
+    engine = (engine or TOPIC_ENGINE).lower()
+    return engine if name in LOCAL_ENGINES and engine == "local" else "llm"
+
+
+def analysis_key(name, data, custom_para, insight, max_tokens, engine="llm"):
+    return cache_key(
+        name, custom_para, insight, MODEL, TEMPERATURE, max_tokens, DIGEST_MIN_CHUNKS, engine, text=data
+    )
+
+
+def final_prompt(name, data, custom_para, insight, max_tokens=CHUNK_TOKENS, progress=None):
+    # The one prompt whose answer is the analysis result, and how many model
+    # calls the analysis takes in total. Documents that fit in one chunk are
+    # sent whole. With DIGEST_MIN_CHUNKS set, very large ones are replaced by
+    # a local digest (statistics plus representative excerpts). Anything else
+    # is map-reduced:
+    # each chunk is analysed on its own, the partial JSON merged locally, and
+    # the returned prompt asks the model to consolidate the merged result.
+    # `progress(done, total)` reports finished map requests.
+    # Incremental analyses always map-reduce, over content-defined chunks
+    # whose partial results are kept between runs.
+    analysis = ANALYSES[name]
+    prompt, chunks = plan(analysis, data, custom_para, insight, max_tokens)
+    if prompt is not None:
+        return prompt, 1
+
+    total = len(chunks) + 1
+    report = progress and (lambda done, _: progress(done, total))
+    if analysis.incremental:
+        partials = map_chunks(analysis, chunks, custom_para, insight, report)
+    else:
+        with span("prompt_build"):
+            prompts = [analysis.prompt(chunk, custom_para, insight) for chunk in chunks]
+        partials = complete_partials(prompts, progress=report)
+    return reduce_partials(analysis, partials, custom_para, insight), total
+
+
+def plan(analysis, data, custom_para, insight, max_tokens):
+    # (prompt, None) when the document is answered by a single prompt,
+    # otherwise (None, chunks) to map-reduce
+    with span("prompt_build"):
+        if analysis.incremental:
+            chunks = list(content_defined_chunks(data.split("\n"), max_tokens))
+        else:
+            chunks = list(chunk_text(data, max_tokens))
+        if len(chunks) <= 1:
+            return analysis.prompt(data, custom_para, insight), None
+        if not analysis.incremental and DIGEST_MIN_CHUNKS and len(chunks) >= DIGEST_MIN_CHUNKS:
+            return analysis.prompt(digest(data, max_tokens), custom_para, insight), None
+    return None, chunks
+
+
+def reduce_partials(analysis, partials, custom_para, insight):
+    with span("response_parse"):
+        merged = analysis.merge([parse_partial(p) for p in partials])
+    with span("prompt_build"):
+        return analysis.reduce_prompt(merged, custom_para, insight, REDUCE_TOKENS)
+
+
+def stored_partials(analysis, chunks, custom_para, insight):
+    # Partial results already stored per chunk, their keys, and the indexes
+    # of the chunks still to send
+    keys = [
+        cache_key(analysis.name, "partial", custom_para, insight, MODEL, TEMPERATURE, text=chunk)
+        for chunk in chunks
+    ]
+    partials = [partial_cache.get(key) for key in keys]
+    return keys, partials, [i for i, partial in enumerate(partials) if partial is None]
+
+
+def store_partials(keys, partials, missing, answers):
+    # Unparseable answers are not stored, so they are retried next run
+    for i, answer in zip(missing, answers):
+        partials[i] = answer
+        if parse_partial(answer) is not None:
+            partial_cache.set(keys[i], answer)
+    return partials
+
+
+def map_chunks(analysis, chunks, custom_para, insight, progress=None):
+    # Partial results per chunk, sending only the chunks without a stored partial
+    keys, partials, missing = stored_partials(analysis, chunks, custom_para, insight)
+    cached = len(chunks) - len(missing)
+    if progress and cached:
+        progress(cached, len(chunks))
+    if not missing:
+        return partials
+    answers = complete_partials(
+        [analysis.prompt(chunks[i], custom_para, insight) for i in missing],
+        progress=progress and (lambda done, _: progress(cached + done, len(chunks))),
+    )
+    return store_partials(keys, partials, missing, answers)
+
+
+def analyse(name, data, custom_para, insight, max_tokens=CHUNK_TOKENS, progress=None, engine="llm"):
+    if engine == "local":
+        with span("local_model"):
+            response = LOCAL_ENGINES[name](data, custom_para, insight, complete=complete)
+        if progress:
+            progress(1, 1)
+        return ANALYSES[name].parse(response)
+    prompt, total = final_prompt(name, data, custom_para, insight, max_tokens, progress)
+    response = complete(prompt)
+    if progress:
+        progress(total, total)
+    return finish(name, response, data)
+
+
+def finish(name, response, data):
+    # Validate the answer against the analysis schema, repairing it locally
+    # or asking again for just the broken fields, then add the local counts
+    with span("response_parse"):
+        return enrich(name, ANALYSES[name].parse(response, complete), data)
+
+
+class AnalysisStream:
+    # Like run_analysis but iterating yields the final answer's text as it is
+    # generated. For map-reduced documents only the reduce step can stream.
+    # Once exhausted, `output` holds the finished result, validated and with
+    # the locally counted fields filled in, which is also what gets cached. Local engines
+    # do not stream and yield their result in one piece.
+
+    def __init__(self, name, data, custom_para, insight, max_tokens=CHUNK_TOKENS, engine=None):
+        self.name = name
+        self.engine = engine_for(name, engine)
+        self.data = data
+        self.custom_para = custom_para
+        self.insight = insight
+        self.max_tokens = max_tokens
+        self.output = None
+
+    def __iter__(self):
+        key = analysis_key(self.name, self.data, self.custom_para, self.insight, self.max_tokens, self.engine)
+        cached = response_cache.get(key)
+        if cached is not None:
+            self.output = cached
+            yield cached
+            return
+        if self.engine == "local":
+            self.output = analyse(
+                self.name, self.data, self.custom_para, self.insight, self.max_tokens, engine=self.engine
+            )
+            response_cache.set(key, self.output)
+            yield self.output
+            return
+
+        prompt, _ = final_prompt(self.name, self.data, self.custom_para, self.insight, self.max_tokens)
+        parts = []
+        for delta in stream(prompt):
+            parts.append(delta)
+            yield delta
+        self.output = finish(self.name, "".join(parts), self.data)
+        response_cache.set(key, self.output)
+
+
+def stream_analysis(name, data, custom_para, insight, max_tokens=CHUNK_TOKENS, engine=None):
+    return AnalysisStream(name, data, custom_para, insight, max_tokens, engine)
+
+
+def in_thread(fn, *args, **kwargs):
+    # Await fn on the loop's default executor, in a copy of the caller's
+    # context so its spans land in the caller's request trace
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, fn, *args, **kwargs))
+
+
+async def afinal_prompt(name, data, custom_para, insight, max_tokens=CHUNK_TOKENS):
+    # final_prompt for the async server: model calls are awaited on the
+    # caller's event loop and the CPU-bound steps run in worker threads
+    analysis = ANALYSES[name]
+    prompt, chunks = await in_thread(plan, analysis, data, custom_para, insight, max_tokens)
+    if prompt is not None:
+        return prompt
+    if analysis.incremental:
+        keys, partials, missing = await in_thread(stored_partials, analysis, chunks, custom_para, insight)
+        if missing:
+            answers = await acomplete_partials([analysis.prompt(chunks[i], custom_para, insight) for i in missing])
+            partials = await in_thread(store_partials, keys, partials, missing, answers)
+    else:
+        with span("prompt_build"):
+            prompts = [analysis.prompt(chunk, custom_para, insight) for chunk in chunks]
+        partials = await acomplete_partials(prompts)
+    return await in_thread(reduce_partials, analysis, partials, custom_para, insight)
+
+
+async def afinish(name, response, data):
+    # finish with the fix-up request awaited, so it goes through the
+    # caller's pooled session too
+    with span("response_parse"):
+        response = await ANALYSES[name].aparse(response, acomplete)
+        return await in_thread(enrich, name, response, data)
+
+
+async def arun_analysis(name, data, custom_para, insight, max_tokens=CHUNK_TOKENS, engine=None):
+    # run_analysis without blocking the event loop; results share its cache
+    engine = engine_for(name, engine)
+    key = analysis_key(name, data, custom_para, insight, max_tokens, engine)
+    cached = await in_thread(response_cache.get, key)
+    if cached is not None:
+        return cached
+    if engine == "local":
+        with span("local_model"):
+            response = await ALOCAL_ENGINES[name](data, custom_para, insight, acomplete=acomplete)
+        response = ANALYSES[name].parse(response)
+    else:
+        prompt = await afinal_prompt(name, data, custom_para, insight, max_tokens)
+        response = await acomplete(prompt)
+        response = await afinish(name, response, data)
+    await in_thread(response_cache.set, key, response)
+    return response
+
+
+def run_analyses(names, data, custom_para, insight, progress=None, engine=None):
+    # Run several analyses over the same extracted text at once, yielding
+    # (name, result dict, error) in completion order. `progress(name, done, total)`
+    # reports chunk progress per analysis. Each thread runs in a copy of the
+    # caller's context so its spans land in the caller's request trace.
+    with ThreadPoolExecutor(max_workers=len(names) or 1) as pool:
+        futures = {
+            pool.submit(
+                contextvars.copy_context().run, run_analysis, name, data, custom_para, insight,
+                progress=progress and (lambda done, total, name=name: progress(name, done, total)), engine=engine,
+            ): name
+            for name in names
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                yield name, ANALYSES[name].load(future.result()), None
+            except Exception as error:
+                yield name, None, str(error)
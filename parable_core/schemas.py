@@ -0,0 +1,262 @@
+import json
+import re
+from typing import Any, Dict, List
+
+from pydantic import BaseModel, Extra, Field, validator
+
+# Result schemas for the analyses, and a local repair pass for model answers
+# that are almost JSON. The models are lenient about shapes the model often
+# gets slightly wrong (a string where a list was asked for, numbers as
+# strings) and strict about anything the frontends index into.
+
+FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL | re.IGNORECASE)
+NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+CLOSERS = {"{": "}", "[": "]"}
+# Placeholders copied from the output templates
+PLACEHOLDERS = frozenset({"", "...", "…"})
+# Truncated answers are cut back one element at a time, this many times at most
+MAX_CUTS = 20
+# Opening brackets tried as the start of the value
+MAX_STARTS = 20
+
+
+def repair_json(text):
+    # The JSON value in a model answer, or None when it cannot be recovered.
+    # Strips code fences and prose around the value, drops trailing commas
+    # and closes strings, arrays and objects left open by a truncated answer.
+    if not isinstance(text, str):
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    fenced = FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    # Prose may carry brackets of its own ("Here is [the] result: {...}"), so
+    # each opening bracket is tried in turn until one starts a value
+    starts = [i for i, char in enumerate(text) if char in CLOSERS][:MAX_STARTS]
+    for start in starts:
+        value = repair_from(text[start:])
+        if value is not None:
+            return value
+    return None
+
+
+def repair_from(text):
+    # The value starting at text[0], or None
+    out, stack, cuts = [], [], []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char in "}]":
+            while out and out[-1] in " \t\r\n,":
+                out.pop()
+            out.append(char)
+            if stack:
+                stack.pop()
+            if not stack:
+                return load(out)
+            continue
+        if char == '"':
+            in_string = True
+        elif char in CLOSERS:
+            stack.append(CLOSERS[char])
+        elif char == ",":
+            cuts.append((len(out), list(stack)))
+        out.append(char)
+
+    # Truncated: close what is open, or cut back to an earlier element
+    if in_string:
+        out.append('"')
+    tail = "".join(out).rstrip().rstrip(",")
+    if tail.endswith(":"):
+        tail += " null"
+    value = load(tail + "".join(reversed(stack)))
+    for length, open_stack in reversed(cuts[-MAX_CUTS:]):
+        if value is not None:
+            break
+        value = load(out[:length] + list(reversed(open_stack)))
+    return value
+
+
+def load(chars):
+    try:
+        return json.loads("".join(chars))
+    except ValueError:
+        return None
+
+
+def as_text(value):
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def as_phrases(value):
+    # A list of strings; "a, b" strings are split and dict items flattened
+    if isinstance(value, str):
+        value = [part.strip() for part in value.strip("[]").split(",")]
+    phrases = []
+    for item in as_list(value):
+        if isinstance(item, dict):
+            item = ", ".join(as_text(v) for v in item.values())
+        item = as_text(item).strip()
+        if item not in PLACEHOLDERS:
+            phrases.append(item)
+    return phrases
+
+
+def as_number(value):
+    if isinstance(value, list):
+        value = value[0] if value else 0
+    if isinstance(value, (int, float)):
+        return value
+    match = NUMBER.search(str(value))
+    number = float(match.group()) if match else 0
+    return int(number) if number.is_integer() else number
+
+
+def as_records(value):
+    # Dict items only; template placeholders like "..." are dropped
+    return [item for item in as_list(value) if isinstance(item, dict)]
+
+
+class Result(BaseModel):
+    custom_parameters: str = ""
+    summary: str = ""
+
+    class Config:
+        # Locally added fields such as word_frequencies pass through
+        extra = Extra.allow
+        allow_population_by_field_name = True
+
+    @validator("custom_parameters", "summary", pre=True, allow_reuse=True)
+    def text(cls, value):
+        return as_text(value)
+
+
+class SentimentResult(Result):
+    positive_words: List[str] = []
+    negative_words: List[str] = []
+    neutral_words: List[str] = []
+
+    _phrases = validator("positive_words", "negative_words", "neutral_words", pre=True, allow_reuse=True)(as_phrases)
+
+
+class EntityContext(BaseModel):
+    entity: str
+    context: str = ""
+
+    _text = validator("entity", "context", pre=True, allow_reuse=True)(as_text)
+
+
+class EntityOccurrence(BaseModel):
+    entity: str
+    count: Any = 0
+
+    _entity = validator("entity", pre=True, allow_reuse=True)(as_text)
+    _count = validator("count", pre=True, allow_reuse=True)(as_number)
+
+
+class EntityResult(Result):
+    named_entities: List[str] = []
+    entity_types: List[str] = Field([], alias="list_of_entity types")
+    contextual_info: List[EntityContext] = []
+    entity_occurrences: List[EntityOccurrence] = []
+
+    _phrases = validator("named_entities", "entity_types", pre=True, allow_reuse=True)(as_phrases)
+    _records = validator("contextual_info", "entity_occurrences", pre=True, allow_reuse=True)(as_records)
+
+
+class TopicWeight(BaseModel):
+    label: str
+    value: List[float]
+
+    _label = validator("label", pre=True, allow_reuse=True)(as_text)
+
+    @validator("value", pre=True)
+    def weights(cls, value):
+        if isinstance(value, str):
+            value = NUMBER.findall(value)
+        return [as_number(v) for v in as_list(value)] or [0]
+
+
+class TopicKeywords(BaseModel):
+    topic: str
+    keywords: List[str] = []
+
+    _topic = validator("topic", pre=True, allow_reuse=True)(as_text)
+    _keywords = validator("keywords", pre=True, allow_reuse=True)(as_phrases)
+
+
+class TopicResult(Result):
+    topics: List[str] = []
+    types: Dict[str, List[str]] = {}
+    topic_distribution: List[TopicWeight] = []
+    topic_keywords: List[TopicKeywords] = []
+    topic_hierarchy: Any = []
+    word_cloud: str = ""
+
+    _topics = validator("topics", pre=True, allow_reuse=True)(as_phrases)
+    _records = validator("topic_distribution", "topic_keywords", pre=True, allow_reuse=True)(as_records)
+
+    @validator("types", pre=True)
+    def phrase_types(cls, value):
+        if not value:
+            return {}
+        if not isinstance(value, dict):
+            raise ValueError("types must be an object of type -> phrases")
+        return {as_text(k): as_phrases(v) for k, v in value.items()}
+
+    @validator("word_cloud", pre=True)
+    def words(cls, value):
+        return " ".join(as_phrases(value)) if isinstance(value, list) else as_text(value)
+
+
+class TrendResult(Result):
+    actionable_insights: List[str] = []
+
+    _phrases = validator("actionable_insights", pre=True, allow_reuse=True)(as_phrases)
+
+
+def labelled(label):
+    # Lists of {label: phrase} objects; bare phrases are wrapped, because the
+    # Streamlit view reads the first value of every item
+    def validate(value):
+        items = []
+        for item in as_list(value):
+            if isinstance(item, dict):
+                item = {as_text(k): as_text(v) for k, v in item.items() if as_text(v) not in PLACEHOLDERS}
+                if item:
+                    items.append(item)
+            elif as_text(item).strip() not in PLACEHOLDERS:
+                items.append({label: as_text(item)})
+        return items
+    return validate
+
+
+class ActionableInsightsResult(Result):
+    actionable_insights: List[Dict[str, str]] = []
+    common_requests: List[Dict[str, str]] = []
+    common_suggestions: List[Dict[str, str]] = []
+    common_criticisms: List[Dict[str, str]] = []
+
+    _insights = validator("actionable_insights", pre=True, allow_reuse=True)(labelled("actionable insight"))
+    _requests = validator("common_requests", pre=True, allow_reuse=True)(labelled("common request"))
+    _suggestions = validator("common_suggestions", pre=True, allow_reuse=True)(labelled("common suggestion"))
+    _criticisms = validator("common_criticisms", pre=True, allow_reuse=True)(labelled("common criticisms"))
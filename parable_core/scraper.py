@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import csv
+import io
+import ipaddress
+import os
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from selectorlib import Extractor
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from parable_core.cache import CACHE_DIR
+from parable_core.csv_prep import fingerprint
+
+SELECTORS = os.getenv(
+    "PARABLE_SELECTORS",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "parable_app", "selectors.yml"),
+)
+# Connections open at once, in total and to any one host
+SCRAPE_CONNECTIONS = int(os.getenv("PARABLE_SCRAPE_CONNECTIONS", 16))
+SCRAPE_CONNECTIONS_PER_HOST = int(os.getenv("PARABLE_SCRAPE_CONNECTIONS_PER_HOST", 4))
+# Review pages followed through `next_page` per start URL, and the most a
+# request may ask for
+MAX_PAGES = int(os.getenv("PARABLE_SCRAPE_MAX_PAGES", 10))
+MAX_REDIRECTS = 5
+SCRAPE_TIMEOUT = 30
+# Hosts that may be scraped, subdomains included; "*" allows any public host
+SCRAPE_HOSTS = tuple(
+    host.strip().lower()
+    for host in os.getenv(
+        "PARABLE_SCRAPE_HOSTS",
+        "amazon.com,amazon.co.uk,amazon.ca,amazon.com.au,amazon.de,amazon.fr,amazon.it,amazon.es,amazon.in,"
+        "amazon.co.jp",
+    ).split(",")
+    if host.strip()
+)
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0 Safari/537.36",
+    "Accept-Language": "en-GB,en;q=0.9",
+}
+
+# Columns of the review store, in the order they are exported
+FIELDS = ("product", "title", "content", "date", "author", "rating", "found_helpful", "variant",
+          "verified_purchase", "images", "url")
+
+
+class Throttled(Exception):
+    pass
+
+
+class BlockedURL(ValueError):
+    pass
+
+
+def public(address):
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+def check_url(url, hosts=SCRAPE_HOSTS, allow_private=False):
+    # Raises BlockedURL unless url is http(s) on an allowed host. Host names
+    # are checked again once resolved, by PublicResolver.
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        raise BlockedURL(f"Only http and https URLs can be scraped: {url}")
+    host = (parts.hostname or "").rstrip(".").lower()
+    if not host:
+        raise BlockedURL(f"No host in URL: {url}")
+    if "*" not in hosts and not any(host == allowed or host.endswith("." + allowed) for allowed in hosts):
+        raise BlockedURL(f"{host} is not an allowed scrape host")
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return url
+    if not (allow_private or public(address)):
+        raise BlockedURL(f"{host} is not a public address")
+    return url
+
+
+class PublicResolver(AbstractResolver):
+    # Refuses host names that resolve to private, loopback, link-local or
+    # reserved addresses, at connect time, so DNS cannot point a scrape
+    # at the internal network
+
+    def __init__(self):
+        self.resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        addresses = await self.resolver.resolve(host, port, family)
+        for address in addresses:
+            if not public(ipaddress.ip_address(address["host"].split("%")[0])):
+                raise BlockedURL(f"{host} resolves to a non-public address")
+        return addresses
+
+    async def close(self):
+        await self.resolver.close()
+
+
+RETRY_POLICY = dict(
+    retry=retry_if_exception_type((aiohttp.ClientError, asyncio.TimeoutError, Throttled)),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+
+
+class ReviewStore:
+    # Scraped reviews in SQLite, one row per distinct review per collection.
+    # The content hash is the primary key, so re-scraping a product only
+    # appends the reviews that are new.
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS reviews (collection TEXT, hash BLOB, "
+            + ", ".join(f"{field} TEXT" for field in FIELDS)
+            + ", scraped REAL, PRIMARY KEY (collection, hash))"
+        )
+        self.db.commit()
+
+    def add(self, collection, reviews):
+        # Insert the reviews not stored yet; returns how many were new
+        now = time.time()
+        rows = [
+            (collection, review_hash(review), *(review.get(field) for field in FIELDS), now)
+            for review in reviews
+        ]
+        with self.lock:
+            before = self.db.total_changes
+            self.db.executemany(
+                f"INSERT OR IGNORE INTO reviews VALUES ({', '.join('?' * (len(FIELDS) + 3))})", rows
+            )
+            self.db.commit()
+            return self.db.total_changes - before
+
+    def collections(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT collection, COUNT(*), MAX(scraped) FROM reviews GROUP BY collection"
+            ).fetchall()
+        return [{"collection": name, "reviews": count, "updated": updated} for name, count, updated in rows]
+
+    def count(self, collection):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM reviews WHERE collection = ?", (collection,)).fetchone()[0]
+
+    def as_file(self, collection):
+        # The collection as a CSV upload, so it goes through the same ingestion
+        # as a manual export
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(FIELDS)} FROM reviews WHERE collection = ? ORDER BY scraped, rowid",
+                (collection,),
+            ).fetchall()
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(FIELDS)
+        writer.writerows(rows)
+        file = io.BytesIO(text.getvalue().encode("utf-8"))
+        file.name = f"{collection}.csv"
+        return file
+
+
+def review_hash(review):
+    return fingerprint(" ".join(str(review.get(field) or "") for field in ("title", "content", "author")))
+
+
+def parse_page(extractor, html, url):
+    # (reviews, next page URL) out of one review page
+    page = extractor.extract(html, base_url=url) or {}
+    product = (page.get("product_title") or "").strip()
+    reviews = []
+    for review in page.get("reviews") or []:
+        if not review or not (review.get("content") or review.get("title")):
+            continue
+        review = {field: (value.strip() if isinstance(value, str) else value) for field, value in review.items()}
+        review["images"] = " ".join(review.get("images") or [])
+        review["product"] = product
+        review["url"] = url
+        reviews.append(review)
+    next_page = page.get("next_page")
+    return reviews, urljoin(url, next_page) if next_page else None
+
+
+async def fetch_once(session, url):
+    # (page text, None), or (None, redirect location)
+    async for attempt in AsyncRetrying(**RETRY_POLICY):
+        with attempt:
+            async with session.get(url, allow_redirects=False) as response:
+                if response.status in (429, 503):
+                    raise Throttled(f"{url} answered {response.status}")
+                if response.status in (301, 302, 303, 307, 308) and "Location" in response.headers:
+                    return None, response.headers["Location"]
+                response.raise_for_status()
+                return await response.text(), None
+
+
+async def fetch(session, url, hosts=SCRAPE_HOSTS, allow_private=False):
+    # Redirects are followed here rather than by aiohttp, so each hop is checked
+    for _ in range(MAX_REDIRECTS + 1):
+        html, location = await fetch_once(session, url)
+        if location is None:
+            return html
+        url = check_url(urljoin(url, location), hosts, allow_private)
+    raise BlockedURL(f"More than {MAX_REDIRECTS} redirects from {url}")
+
+
+async def scrape_product(session, extractor, store, collection, url, max_pages, hosts=SCRAPE_HOSTS,
+                         allow_private=False):
+    # Follow one product's review pages in order, storing each page as it is
+    # parsed. A next page off the allowed hosts ends the product.
+    pages = new = 0
+    seen_urls = set()
+    while url and pages < max_pages and url not in seen_urls:
+        seen_urls.add(url)
+        html = await fetch(session, url, hosts, allow_private)
+        reviews, url = parse_page(extractor, html, url)
+        pages += 1
+        new += store.add(collection, reviews)
+        if not reviews:
+            break
+        if url:
+            try:
+                check_url(url, hosts, allow_private)
+            except BlockedURL:
+                break
+    return pages, new
+
+
+async def scrape(urls, collection, store, max_pages=MAX_PAGES, connections=SCRAPE_CONNECTIONS,
+                 connections_per_host=SCRAPE_CONNECTIONS_PER_HOST, hosts=SCRAPE_HOSTS, allow_private=False):
+    # Scrape the start URLs concurrently over one pooled session. Returns
+    # {"pages", "new_reviews", "errors"}; a URL that keeps failing, or is not
+    # allowed, is reported without stopping the others.
+    max_pages = max(1, min(max_pages, MAX_PAGES))
+    extractor = Extractor.from_yaml_file(SELECTORS)
+    resolver = None if allow_private else PublicResolver()
+    connector = aiohttp.TCPConnector(limit=connections, limit_per_host=connections_per_host, resolver=resolver)
+    timeout = aiohttp.ClientTimeout(total=SCRAPE_TIMEOUT)
+
+    async def scrape_url(url):
+        check_url(url, hosts, allow_private)
+        return await scrape_product(session, extractor, store, collection, url, max_pages, hosts, allow_private)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS) as session:
+        results = await asyncio.gather(*(scrape_url(url) for url in urls), return_exceptions=True)
+    summary = {"pages": 0, "new_reviews": 0, "errors": {}}
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            summary["errors"][url] = str(result) or type(result).__name__
+        else:
+            summary["pages"] += result[0]
+            summary["new_reviews"] += result[1]
+    summary["reviews"] = store.count(collection)
+    return summary
+
+
+store = ReviewStore(os.path.join(CACHE_DIR, "reviews.sqlite3"))
+
+
+def scrape_reviews(urls, collection, max_pages=MAX_PAGES):
+    return asyncio.run(scrape(urls, collection, store, max_pages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scrape product reviews into the local review store")
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--max-pages", type=int, default=MAX_PAGES)
+    args = parser.parse_args()
+    print(scrape_reviews(args.urls, args.collection, args.max_pages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import json
+import re
+from collections import Counter
+
+import numpy as np
+
+from parable_core.chunking import CHARS_PER_TOKEN, iter_sentences
+
+WORD = re.compile(r"[a-z][a-z0-9'-]*[a-z0-9]|[a-z]")
+# Runs of capitalised words, e.g. "Amazon Prime"
+PROPER_NOUN = re.compile(r"\b[A-Z][a-zA-Z0-9&'-]*(?:[ \t]+[A-Z][a-zA-Z0-9&'-]*)*")
+SENTENCE_START = re.compile(r"(?:^|[.!?\n])\s*$")
+
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before
+being below between both but by can could did do does doing down during each even few for
+from further get got had has have having he her here hers herself him himself his how i if
+in into is it its itself just like me more most my myself no nor not now of off on once
+only or other our ours ourselves out over own really same she should so some still such
+than that the their theirs them themselves then there these they this those through to too
+under until up us very was we were what when where which while who whom why will with
+would you your yours yourself yourselves one two get gets got make made much many well
+""".split())
+
+POSITIVE = frozenset("""
+amazing awesome beautiful best better comfortable durable easy excellent fantastic fast
+fine flawless good great happy helpful impressive love loved loves lovely nice perfect
+pleased pleasant quick recommend reliable satisfied smooth solid sturdy superb worth wonderful
+""".split())
+NEGATIVE = frozenset("""
+annoying awful bad broke broken cheap cracked defective difficult disappointed disappointing
+expensive fail failed faulty flimsy hate horrible issue issues junk poor problem problems refund
+return returned slow terrible unhappy useless waste worse worst wrong
+""".split())
+NEGATIONS = frozenset("not no never hardly isn't wasn't don't doesn't didn't can't won't".split())
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+def content_words(tokens):
+    return [t for t in tokens if t not in STOPWORDS and len(t) > 2]
+
+
+def term_counts(text, top=100):
+    # Exact frequencies of the content words, most frequent first
+    words = np.array(content_words(tokenize(text)))
+    if not len(words):
+        return {}
+    terms, counts = np.unique(words, return_counts=True)
+    order = np.argsort(-counts, kind="stable")[:top]
+    return {str(terms[i]): int(counts[i]) for i in order}
+
+
+def ngram_counts(text, n=2, top=30):
+    # Phrases of n content words that appear next to each other in a sentence
+    counts = Counter()
+    for start, end, _ in iter_sentences(text):
+        words = tokenize(text[start:end])
+        for i in range(len(words) - n + 1):
+            gram = words[i:i + n]
+            if gram[0] in STOPWORDS or gram[-1] in STOPWORDS:
+                continue
+            counts[" ".join(gram)] += 1
+    return {gram: count for gram, count in counts.most_common(top) if count > 1}
+
+
+def sentence_sentiment(sentence_tokens):
+    # Lexicon score in [-1, 1]; a negation flips the next sentiment word
+    score, flip = 0, False
+    for token in sentence_tokens:
+        if token in NEGATIONS:
+            flip = True
+            continue
+        polarity = (token in POSITIVE) - (token in NEGATIVE)
+        if polarity:
+            score += -polarity if flip else polarity
+            flip = False
+    return max(-1.0, min(1.0, score / 3))
+
+
+def tfidf_sentences(sentences):
+    # TF-IDF weight of each sentence (sum over its terms, length-normalised),
+    # and the vocabulary terms ranked by their total TF-IDF mass
+    tokenised = [content_words(tokenize(s)) for s in sentences]
+    vocabulary = {}
+    rows, cols = [], []
+    for row, words in enumerate(tokenised):
+        for word in words:
+            rows.append(row)
+            cols.append(vocabulary.setdefault(word, len(vocabulary)))
+    if not vocabulary:
+        return np.zeros(len(sentences)), []
+    rows, cols = np.array(rows), np.array(cols)
+    # Term frequency per (sentence, term) pair as a sparse coordinate list
+    pairs, tf = np.unique(rows * len(vocabulary) + cols, return_counts=True)
+    pair_rows, pair_cols = pairs // len(vocabulary), pairs % len(vocabulary)
+    df = np.bincount(pair_cols, minlength=len(vocabulary))
+    idf = np.log((1 + len(sentences)) / (1 + df)) + 1
+    weights = tf * idf[pair_cols]
+    lengths = np.bincount(rows, minlength=len(sentences))
+    sentence_scores = np.bincount(pair_rows, weights=weights, minlength=len(sentences))
+    sentence_scores = sentence_scores / np.sqrt(np.maximum(lengths, 1))
+    term_mass = np.bincount(pair_cols, weights=weights, minlength=len(vocabulary))
+    terms = np.array(list(vocabulary))
+    return sentence_scores, [str(t) for t in terms[np.argsort(-term_mass)]]
+
+
+def entity_counts(text, entities):
+    # Exact, case-insensitive, whole-word occurrences of each entity in the text
+    counts = []
+    for entity in entities:
+        entity = str(entity).strip()
+        if entity:
+            pattern = r"(?<!\w)" + re.escape(entity) + r"(?!\w)"
+            counts.append({"entity": entity, "count": len(re.findall(pattern, text, re.IGNORECASE))})
+    return counts
+
+
+def proper_nouns(text, top=30):
+    counts = Counter()
+    for match in PROPER_NOUN.finditer(text):
+        name = match.group()
+        # A sentence's first word is capitalised anyway, so it does not count
+        if SENTENCE_START.search(text[max(0, match.start() - 4):match.start()]):
+            name = name.partition(" ")[2].strip()
+        if len(name) > 1:
+            counts[name] += 1
+    return dict(counts.most_common(top))
+
+
+def digest(text, max_tokens):
+    # A compact stand-in for a document too big to send whole: exact local
+    # statistics plus the most representative sentences, within max_tokens
+    spans = list(iter_sentences(text))
+    sentences = [text[start:end].strip() for start, end, _ in spans]
+    scores, key_terms = tfidf_sentences(sentences)
+    sentiments = np.array([sentence_sentiment(tokenize(s)) for s in sentences]) if sentences else np.zeros(0)
+
+    header = json.dumps({
+        "sentences": len(sentences),
+        "top_terms": term_counts(text, top=40),
+        "key_phrases": list(ngram_counts(text, 2, 20)) + list(ngram_counts(text, 3, 10)),
+        "tfidf_keywords": key_terms[:25],
+        "capitalised_names": proper_nouns(text, 25),
+        "sentence_sentiment": {
+            "positive": int((sentiments > 0).sum()),
+            "negative": int((sentiments < 0).sum()),
+            "neutral": int((sentiments == 0).sum()),
+        },
+    }, ensure_ascii=False)
+
+    # Best sentences by TF-IDF, skipping near-repeats, then put back in document order
+    budget = max_tokens * CHARS_PER_TOKEN - len(header)
+    chosen, seen = [], []
+    for i in np.argsort(-scores):
+        words = set(content_words(tokenize(sentences[i])))
+        if not words or any(len(words & other) > 0.6 * len(words) for other in seen):
+            continue
+        if len(sentences[i]) + 1 > budget:
+            continue
+        chosen.append(i)
+        seen.append(words)
+        budget -= len(sentences[i]) + 1
+        if budget < 40:
+            break
+    excerpts = "\n".join(sentences[i] for i in sorted(chosen))
+
+    return (
+        "[Document digest: statistics computed over the full text]\n"
+        f"{header}\n"
+        f"[Representative excerpts: {len(chosen)} of {len(sentences)} sentences]\n"
+        f"{excerpts}"
+    )
+
+
+def enrich(name, response, text):
+    # Overwrite the count-like fields of a model answer with exact local counts
+    try:
+        result = json.loads(response)
+    except (TypeError, ValueError):
+        return response
+    if not isinstance(result, dict):
+        return response
+
+    if name == "entity_recognition" and isinstance(result.get("named_entities"), list):
+        result["entity_occurrences"] = entity_counts(text, result["named_entities"])
+    elif name == "topic_modelling":
+        frequencies = term_counts(text, top=150)
+        if frequencies:
+            result["word_cloud"] = " ".join(frequencies)
+            result["word_frequencies"] = frequencies
+    return json.dumps(result, ensure_ascii=False)
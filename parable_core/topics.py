@@ -0,0 +1,246 @@
+import asyncio
+import heapq
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+from parable_core.chunking import iter_sentences
+from parable_core.csv_prep import SUMMARY_LINE
+from parable_core.schemas import repair_json
+from parable_core.textstats import content_words, term_counts, tokenize
+
+TOPICS = int(os.getenv("PARABLE_TOPICS", 8))
+VOCABULARY_SIZE = 2000
+BATCH_SIZE = 1024
+EPOCHS = 2
+EPSILON = 1e-10
+
+LABEL_PROMPT = '''You are a text to insight service. Topics were extracted from a document with NMF.
+        For each topic you get its top keywords and a few representative excerpts. Give every topic a short label,
+        group important phrases from the excerpts by type (feature suggestions, product improvements, suggestions, critique etc.),
+        summarise the document and answer the custom parameters.
+        topics: {topics},
+        custom parameters: {custom_para},
+        insight: {insight}
+        '''
+LABEL_OUTPUT = '''
+        Return the output in the following JSON format, with one label per topic in the same order:
+
+        {
+            "topics": ["label of topic 1", "label of topic 2", "..."],
+            "types": {
+                "type1": ["phrase"],
+                "type2": ["phrase"],
+                "..."
+            },
+            "custom_parameters": "answer to the custom parameters",
+            "summary": "summary goes here"
+        }
+        '''
+
+
+def documents(text, min_documents):
+    # Rows or paragraphs are the documents; short texts fall back to sentences
+    docs = [line.strip() for line in text.split("\n") if line.strip()]
+    if docs and SUMMARY_LINE.match(docs[-1]):
+        # A prepared CSV: the column header and the summary line are not rows
+        docs = docs[1:-1]
+        text = "\n".join(docs)
+    if len(docs) < min_documents:
+        docs = [text[start:end].strip() for start, end, _ in iter_sentences(text)]
+    return docs
+
+
+class TopicModel:
+    # NMF over TF-IDF fitted in minibatches with the online algorithm of
+    # Mairal et al. (the one behind scikit-learn's MiniBatchNMF), so memory is
+    # bounded by batch_size x vocabulary_size no matter how many rows there are.
+
+    def __init__(self, topics=TOPICS, vocabulary_size=VOCABULARY_SIZE, batch_size=BATCH_SIZE,
+                 epochs=EPOCHS, seed=0):
+        self.topics = topics
+        self.vocabulary_size = vocabulary_size
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.rng = np.random.default_rng(seed)
+        self.vocabulary = {}
+        self.idf = None
+        self.components = None
+        # Running sufficient statistics of the online updates
+        self.A = None
+        self.B = None
+
+    def build_vocabulary(self, docs):
+        df = Counter()
+        for doc in docs:
+            df.update(set(content_words(tokenize(doc))))
+        n = len(docs)
+        # Words in a single row carry no topic; words in most rows carry no contrast
+        kept = [(count, word) for word, count in df.items() if count >= 2 and count <= 0.5 * n] or \
+            [(count, word) for word, count in df.items()]
+        kept = sorted(kept, reverse=True)[: self.vocabulary_size]
+        self.vocabulary = {word: i for i, (_, word) in enumerate(kept)}
+        counts = np.array([count for count, _ in kept], dtype="float64")
+        self.idf = np.log((1 + n) / (1 + counts)) + 1
+
+    def vectorise(self, docs):
+        # Dense, row-normalised TF-IDF for one minibatch
+        X = np.zeros((len(docs), len(self.vocabulary)))
+        for row, doc in enumerate(docs):
+            for word in content_words(tokenize(doc)):
+                column = self.vocabulary.get(word)
+                if column is not None:
+                    X[row, column] += 1
+        X *= self.idf
+        norms = np.linalg.norm(X, axis=1, keepdims=True)
+        return X / np.maximum(norms, EPSILON)
+
+    def transform_batch(self, X, iterations=50):
+        # Document-topic weights W for fixed components H, multiplicative updates
+        H = self.components
+        W = np.full((X.shape[0], self.topics), 1.0 / self.topics)
+        HHt = H @ H.T
+        XHt = X @ H.T
+        for _ in range(iterations):
+            W *= XHt / np.maximum(W @ HHt, EPSILON)
+        return W
+
+    def partial_fit(self, X, decay):
+        W = self.transform_batch(X)
+        self.A = decay * self.A + W.T @ X
+        self.B = decay * self.B + W.T @ W
+        H = self.components
+        for _ in range(10):
+            H *= self.A / np.maximum(self.B @ H, EPSILON)
+        self.components = H
+
+    def batches(self, docs):
+        for start in range(0, len(docs), self.batch_size):
+            yield docs[start:start + self.batch_size]
+
+    def fit(self, docs):
+        self.build_vocabulary(docs)
+        self.topics = max(1, min(self.topics, len(self.vocabulary), len(docs)))
+        self.components = self.rng.random((self.topics, len(self.vocabulary))) + 0.1
+        self.A = np.zeros((self.topics, len(self.vocabulary)))
+        self.B = np.zeros((self.topics, self.topics))
+        order = np.arange(len(docs))
+        for _ in range(self.epochs):
+            self.rng.shuffle(order)
+            shuffled = [docs[i] for i in order]
+            for batch in self.batches(shuffled):
+                # Forget old statistics a little so early random components wash out
+                self.partial_fit(self.vectorise(batch), decay=0.95)
+        return self
+
+    def describe(self, docs, keywords=10, excerpts=3):
+        # Topic keywords, share of the corpus per topic, and the rows most
+        # strongly about each topic
+        terms = np.array(sorted(self.vocabulary, key=self.vocabulary.get))
+        top_terms = [terms[np.argsort(-row)[:keywords]].tolist() for row in self.components]
+
+        mass = np.zeros(self.topics)
+        best = [[] for _ in range(self.topics)]
+        for offset, batch in enumerate(self.batches(docs)):
+            W = self.transform_batch(self.vectorise(batch))
+            weights = W / np.maximum(W.sum(axis=1, keepdims=True), EPSILON)
+            mass += weights.sum(axis=0)
+            for topic in range(self.topics):
+                for row in np.argsort(-W[:, topic])[:excerpts]:
+                    item = (float(W[row, topic]), offset * self.batch_size + int(row))
+                    if len(best[topic]) < excerpts:
+                        heapq.heappush(best[topic], item)
+                    else:
+                        heapq.heappushpop(best[topic], item)
+
+        distribution = mass / max(mass.sum(), EPSILON)
+        examples = [[docs[i][:300] for _, i in sorted(heap, reverse=True)] for heap in best]
+        return top_terms, distribution, examples
+
+    def hierarchy(self, labels, threshold=0.2):
+        # Pair each topic with its most similar other topic when their keyword
+        # distributions overlap enough (cosine similarity of the components)
+        H = self.components / np.maximum(np.linalg.norm(self.components, axis=1, keepdims=True), EPSILON)
+        similarity = H @ H.T
+        np.fill_diagonal(similarity, -1)
+        related = []
+        for topic in range(self.topics):
+            other = int(np.argmax(similarity[topic])) if self.topics > 1 else topic
+            if other != topic and similarity[topic, other] >= threshold:
+                related.append({
+                    "topic": labels[topic],
+                    "related_to": labels[other],
+                    "similarity": round(float(similarity[topic, other]), 3),
+                })
+        return related
+
+
+def fit_topics(data, topics=TOPICS):
+    # The NMF model of a document: (model, keywords, distribution, examples)
+    docs = documents(data, min_documents=topics * 2)
+    model = TopicModel(topics=topics).fit(docs)
+    return (model,) + model.describe(docs)
+
+
+def label_prompt(fitted, custom_para, insight):
+    # One request with keywords and a few excerpts only, asking the model to
+    # label the topics, type phrases and write the summary
+    _, keywords, distribution, examples = fitted
+    described = [
+        {"topic": i + 1, "keywords": words, "share": round(float(share), 3), "excerpts": excerpt}
+        for i, (words, share, excerpt) in enumerate(zip(keywords, distribution, examples))
+    ]
+    return LABEL_PROMPT.format(
+        topics=json.dumps(described, ensure_ascii=False), custom_para=custom_para, insight=insight
+    ) + LABEL_OUTPUT
+
+
+def topic_result(fitted, data, answer=None):
+    # The topic_modelling JSON from the fitted model and the labelling answer, if any
+    model, keywords, distribution, _ = fitted
+    labels = [", ".join(words[:3]) for words in keywords]
+    result = {
+        "topics": labels,
+        "types": {},
+        "custom_parameters": "",
+        "summary": "",
+    }
+    answer = repair_json(answer)
+    if isinstance(answer, dict):
+        if isinstance(answer.get("topics"), list) and len(answer["topics"]) == len(labels):
+            result["topics"] = [str(label) for label in answer["topics"]]
+        for field in ("types", "custom_parameters", "summary"):
+            if field in answer:
+                result[field] = answer[field]
+
+    labels = result["topics"]
+    frequencies = term_counts(data, top=150)
+    result.update({
+        "topic_distribution": [
+            {"label": label, "value": [round(float(share), 4)]} for label, share in zip(labels, distribution)
+        ],
+        "topic_keywords": [{"topic": label, "keywords": words} for label, words in zip(labels, keywords)],
+        "topic_hierarchy": model.hierarchy(labels),
+        "word_cloud": " ".join(frequencies),
+        "word_frequencies": frequencies,
+    })
+    return json.dumps(result, ensure_ascii=False)
+
+
+def local_topic_modelling(data, custom_para, insight, complete=None, topics=TOPICS):
+    # Fill the topic_modelling JSON schema from a local NMF model. When
+    # `complete` is given the model is asked once to label the topics.
+    fitted = fit_topics(data, topics)
+    answer = complete(label_prompt(fitted, custom_para, insight)) if complete is not None else None
+    return topic_result(fitted, data, answer)
+
+
+async def alocal_topic_modelling(data, custom_para, insight, acomplete=None, topics=TOPICS):
+    # local_topic_modelling for the event loop: the model is fitted in a
+    # worker thread and the labelling request awaited
+    loop = asyncio.get_running_loop()
+    fitted = await loop.run_in_executor(None, fit_topics, data, topics)
+    answer = await acomplete(label_prompt(fitted, custom_para, insight)) if acomplete is not None else None
+    return await loop.run_in_executor(None, topic_result, fitted, data, answer)
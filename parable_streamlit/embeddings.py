@@ -0,0 +1,205 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import openai
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# The embeddings endpoint accepts a list of inputs per request
+BATCH_SIZE = int(os.getenv("PARABLE_EMBEDDING_BATCH", 256))
+EMBEDDING_WORKERS = int(os.getenv("PARABLE_EMBEDDING_WORKERS", 4))
+EMBEDDING_CACHE = os.getenv(
+    "PARABLE_EMBEDDING_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "parable", "embeddings.sqlite3"),
+)
+
+
+class OpenAIBatchEmbeddings:
+    # Same interface as langchain's OpenAIEmbeddings, but one request per batch
+    # of texts instead of one per text
+
+    def __init__(self, model=EMBEDDING_MODEL):
+        self.model = model
+
+    @retry(
+        retry=retry_if_exception_type((openai.error.RateLimitError, openai.error.APIError,
+                                       openai.error.Timeout, openai.error.ServiceUnavailableError)),
+        wait=wait_random_exponential(min=1, max=60),
+        stop=stop_after_attempt(6),
+        reraise=True,
+    )
+    def embed_batch(self, texts):
+        response = openai.Embedding.create(input=[t.replace("\n", " ") for t in texts], model=self.model)
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+    def embed_documents(self, texts):
+        return self.embed_batch(texts) if texts else []
+
+    def embed_query(self, text):
+        return self.embed_batch([text])[0]
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings:
+    # Wraps an embeddings backend with a SQLite store keyed by the model and a
+    # hash of the chunk text. Only chunks never seen before are sent to the
+    # backend, in batches of `batch_size` running `workers` at a time.
+
+    def __init__(self, base, path=EMBEDDING_CACHE, batch_size=BATCH_SIZE, workers=EMBEDDING_WORKERS):
+        self.base = base
+        self.namespace = getattr(base, "model", type(base).__name__)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.db.commit()
+
+    def key(self, text):
+        return f"{self.namespace}:{content_hash(text)}"
+
+    def lookup(self, keys):
+        found = {}
+        with self.lock:
+            # Stay under SQLite's limit on bound parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                found.update((key, np.frombuffer(vector, dtype="float32")) for key, vector in rows)
+        return found
+
+    def store(self, items):
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype="float32").tobytes()) for key, vector in items],
+            )
+            self.db.commit()
+
+    def embed_documents(self, texts):
+        keys = [self.key(text) for text in texts]
+        vectors = self.lookup(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing[key] = text
+        if missing:
+            missing_keys = list(missing)
+            batches = [
+                missing_keys[start:start + self.batch_size]
+                for start in range(0, len(missing_keys), self.batch_size)
+            ]
+
+            def embed(batch):
+                embedded = self.base.embed_documents([missing[key] for key in batch])
+                self.store(zip(batch, embedded))
+                return batch, embedded
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for batch, embedded in pool.map(embed, batches):
+                    vectors.update(zip(batch, (np.asarray(v, dtype="float32") for v in embedded)))
+
+        return [vectors[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.base.embed_query(text)
+
+
+# A Hugging Face hub name, downloaded into the HF cache on first use, or the
+# path of a directory holding a saved model and tokenizer. To run without
+# network access, point this at such a directory (or pre-fill the cache and
+# set TRANSFORMERS_OFFLINE=1).
+LOCAL_MODEL = os.getenv("PARABLE_LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def load_local_model(name):
+    # (tokenizer, tokenizer lock, model, torch), loaded once per process and
+    # shared by every caller. torch is not in requirements.txt, as only this
+    # backend needs it.
+    with _models_lock:
+        if name not in _models:
+            try:
+                import torch
+                from transformers import AutoModel, AutoTokenizer
+            except ImportError as error:
+                raise ImportError(
+                    f"PARABLE_EMBEDDINGS=local needs torch and transformers ({error}). Install a CPU build with "
+                    "pip install torch --extra-index-url https://download.pytorch.org/whl/cpu"
+                ) from error
+
+            tokenizer = AutoTokenizer.from_pretrained(name, use_fast=True)
+            model = AutoModel.from_pretrained(name)
+            model.eval()
+            # A fast tokenizer called with padding/truncation changes its own
+            # settings, so concurrent calls fail with "Already borrowed"
+            _models[name] = (tokenizer, threading.Lock(), model, torch)
+        return _models[name]
+
+
+def mean_pool(hidden, mask):
+    # Average the token vectors that are not padding, then L2-normalise
+    mask = mask[:, :, None].astype("float32")
+    summed = (hidden * mask).sum(axis=1)
+    pooled = summed / np.clip(mask.sum(axis=1), 1e-9, None)
+    return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+
+class LocalEmbeddings:
+    # Sentence embeddings computed on CPU, no network round trip per chunk or query
+
+    def __init__(self, model=LOCAL_MODEL, batch_size=64, workers=EMBEDDING_WORKERS, max_length=256):
+        self.model = model
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_length = max_length
+
+    def embed_batch(self, texts):
+        tokenizer, tokenizer_lock, model, torch = load_local_model(self.model)
+        # Only the forward pass runs concurrently
+        with tokenizer_lock:
+            encoded = tokenizer(
+                texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt"
+            )
+        with torch.no_grad():
+            hidden = model(**encoded).last_hidden_state
+        return mean_pool(hidden.numpy(), encoded["attention_mask"].numpy())
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        # Batch texts of similar length together so little time goes on padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        vectors = [None] * len(texts)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for batch, embedded in zip(batches, pool.map(lambda b: self.embed_batch([texts[i] for i in b]), batches)):
+                for i, vector in zip(batch, embedded):
+                    vectors[i] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_batch([text])[0].tolist()
+
+
+def get_embeddings(backend=None):
+    # PARABLE_EMBEDDINGS=local switches semantic search to the local model.
+    # Cached vectors are namespaced by model, so the two never mix.
+    backend = backend or os.getenv("PARABLE_EMBEDDINGS", "openai")
+    if backend == "local":
+        return CachedEmbeddings(LocalEmbeddings())
+    return CachedEmbeddings(OpenAIBatchEmbeddings())
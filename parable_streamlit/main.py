@@ -1,14 +1,105 @@
 import streamlit as st
 import pandas as pd
 from wordcloud import WordCloud
-import matplotlib.pyplot as plt
-from app import sentiment_analysis, topic_modelling, entity_recognition, actionable_insights
+from app import ANALYSES, sentiment_analysis, stream_text
+import hashlib
+import threading
+from cachetools import LRUCache
 import plotly.graph_objects as go
 import plotly.express as px
 #from semantic_search import source_docs, print_answer, search_index
 #from streamlit_chat import message
 
 
+# Finished results kept per server process, shared by every session
+RESULT_ENTRIES = 64
+
+
+@st.cache_resource
+def result_store():
+    return threading.Lock(), LRUCache(maxsize=RESULT_ENTRIES)
+
+
+def file_hash(uploaded_file):
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+
+def view_result(view, submitted, uploaded_file, parameters, compute):
+    # A fresh result when the form is submitted, otherwise the last one this
+    # session showed, so reruns redraw the view without calling the model.
+    # Results are keyed on the upload's hash and the parameters and kept in
+    # session state and in a process-wide store, so resubmitting the same
+    # file, here or in another session, skips the analysis too.
+    if not (submitted and uploaded_file is not None):
+        last = st.session_state.get(view)
+        return last[1] if last else None
+
+    key = (view, file_hash(uploaded_file)) + tuple(parameters)
+    last = st.session_state.get(view)
+    if last and last[0] == key:
+        return last[1]
+    lock, results = result_store()
+    with lock:
+        data = results.get(key)
+    if data is None:
+        data = compute()
+        with lock:
+            results[key] = data
+    st.session_state[view] = (key, data)
+    return data
+
+
+def streamed(analysis, uploaded_file, custom_parameters, insight, engine=None):
+    # Show the model's output as it streams in, then hand back the parsed result
+    placeholder = st.empty()
+    text = ""
+    stream = stream_text(analysis, uploaded_file, custom_parameters, insight, engine=engine)
+    for delta in stream:
+        text += delta
+        placeholder.code(text, language="json")
+    placeholder.empty()
+    return ANALYSES[analysis].load(stream.output)
+
+
+def analyse(analysis, submitted, uploaded_file, custom_parameters, insight, engine=None):
+    return view_result(
+        analysis, submitted, uploaded_file, (custom_parameters, insight, engine),
+        lambda: streamed(analysis, uploaded_file, custom_parameters, insight, engine),
+    )
+
+
+# Figures are cached on their inputs, so reruns reuse them instead of redrawing
+
+@st.cache_data(show_spinner=False, max_entries=RESULT_ENTRIES)
+def word_cloud(frequencies=None, text=""):
+    # An RGB array for st.image, drawn without matplotlib
+    cloud = WordCloud(width=800, height=400)
+    cloud = cloud.generate_from_frequencies(frequencies) if frequencies else cloud.generate(text)
+    return cloud.to_array()
+
+
+@st.cache_data(show_spinner=False, max_entries=RESULT_ENTRIES)
+def pie_chart(labels, values):
+    fig = go.Figure(data=[go.Pie(labels=labels, values=values)])
+    fig.update_layout(title='Analysis - Pie Chart')
+    return fig
+
+
+@st.cache_data(show_spinner=False, max_entries=RESULT_ENTRIES)
+def topic_chart(labels, values):
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=labels, y=values))
+    fig.update_layout(xaxis_tickangle=-45, yaxis_range=[0, max([0.3] + values)], xaxis_title="Topic", yaxis_title="Value")
+    return fig
+
+
+@st.cache_data(show_spinner=False, max_entries=RESULT_ENTRIES)
+def entity_charts(entity_types, entity_occurrences):
+    types = px.pie(entity_types, names=entity_types, title="List of Entity Types")
+    occurrences = px.bar(entity_occurrences, x="entity", y="count", title="Entity Occurrences")
+    return types, occurrences
+
+
 def main():
     st.set_page_config(page_title='Parable - A Text to Insight Tool')
 
@@ -52,11 +143,39 @@ def main():
         custom_parameters = form.text_input('Add Custom Parameters')
         insight = form.text_input('Tell us a little bit about your data')
 
+        batch = form.checkbox('Analyse each row of a CSV separately')
+
         submit_button = form.form_submit_button(label='Analyse')
 
-        if submit_button and uploaded_file is not None:
-            data = sentiment_analysis(uploaded_file, custom_parameters, insight)
+        if batch:
+            with st.spinner('Analysing rows'):
+                data = view_result(
+                    "sentiment_batch", submit_button, uploaded_file, (custom_parameters, insight),
+                    lambda: sentiment_analysis(uploaded_file, custom_parameters, insight, batch=True),
+                )
+        else:
+            data = analyse("sentiment_analysis", submit_button, uploaded_file, custom_parameters, insight)
+
+        if data is not None and batch:
+            aggregates = data["aggregates"]
+
+            st.subheader("Summary")
+            st.write("{} of {} rows analysed, mean score {}".format(
+                aggregates["analysed"], aggregates["rows"], aggregates["mean_score"]))
+
+            counts = aggregates["sentiment_counts"]
+            st.plotly_chart(pie_chart([s.title() for s in counts], list(counts.values())))
+
+            for sentiment, phrases in aggregates["top_phrases"].items():
+                st.subheader("Top {} phrases".format(sentiment))
+                st.table(list(phrases.items()))
+
+            st.subheader("Rows")
+            st.dataframe(data["rows"])
+            with open(data["results_path"], "rb") as results:
+                st.download_button('Download results (Parquet)', results, file_name='sentiment.parquet')
 
+        elif data is not None:
             st.subheader("Summary")
             st.write(data["summary"])
 
@@ -73,14 +192,8 @@ def main():
                 'Neutral': len(data['neutral_words'])
             }
 
-            # Create the pie chart
-            fig = go.Figure(data=[go.Pie(labels=list(new_data.keys()), values=list(new_data.values()))])
-
-            # Set the title of the chart
-            fig.update_layout(title='Analysis - Pie Chart')
-
-            # Render the chart using Streamlit
-            st.plotly_chart(fig)
+            # Render the pie chart using Streamlit
+            st.plotly_chart(pie_chart(list(new_data.keys()), list(new_data.values())))
 
             # Display summary and custom parameters
 
@@ -97,11 +210,12 @@ def main():
 
         custom_parameters = form.text_input('Add Custom Parameters')
         insight = form.text_input('Tell us a little bit about your data')
+        engine = form.radio('Engine', ('llm', 'local'), help='local models topics on this machine and uses the LLM only to label them')
 
         submit_button = form.form_submit_button(label='Analyse')
 
-        if submit_button and uploaded_file is not None:
-            data = topic_modelling(uploaded_file, custom_parameters, insight)
+        data = analyse("topic_modelling", submit_button, uploaded_file, custom_parameters, insight, engine=engine)
+        if data is not None:
 
             st.subheader('Results')
 
@@ -133,12 +247,9 @@ def main():
 
             try:
                 # Plot the distribution graph
-                fig = go.Figure()
                 labels = [t["label"] for t in data["topic_distribution"]]
                 values = [t["value"][0] for t in data["topic_distribution"]]
-                fig.add_trace(go.Bar(x=labels, y=values))
-                fig.update_layout(xaxis_tickangle=-45, yaxis_range=[0, 0.3], xaxis_title="Topic", yaxis_title="Value")
-                st.plotly_chart(fig)
+                st.plotly_chart(topic_chart(labels, values))
             except Exception: 
                 pass
             
@@ -154,12 +265,7 @@ def main():
             try:
                 # Create a word cloud
                 st.write("## Word Cloud")
-                st.set_option('deprecation.showPyplotGlobalUse', False)
-                wordcloud = WordCloud(width=800, height=400).generate(data["word_cloud"])
-                plt.figure(figsize=(16, 8))
-                plt.imshow(wordcloud)
-                plt.axis("off")
-                st.pyplot()
+                st.image(word_cloud(data.get("word_frequencies"), data.get("word_cloud", "")), use_column_width=True)
             except Exception:
                 pass
 
@@ -179,8 +285,8 @@ def main():
 
         submit_button = form.form_submit_button(label='Analyse')
 
-        if submit_button and uploaded_file is not None:
-            data = entity_recognition(uploaded_file, custom_parameters, insight)
+        data = analyse("entity_recognition", submit_button, uploaded_file, custom_parameters, insight)
+        if data is not None:
 
             df = data
 
@@ -194,8 +300,8 @@ def main():
 
             # List of entity types pie chart
             st.write("## Entity Types")
-            fig = px.pie(df["list_of_entity types"], names=df["list_of_entity types"], title="List of Entity Types")
-            st.plotly_chart(fig)
+            types_chart, occurrences_chart = entity_charts(df["list_of_entity types"], df["entity_occurrences"])
+            st.plotly_chart(types_chart)
 
             # Contextual info table
             st.write("## Contextual Info")
@@ -204,8 +310,7 @@ def main():
 
             # Entity occurrences graph
             st.write("## Entity Occurrences")
-            fig = px.bar(df["entity_occurrences"], x="entity", y="count", title="Entity Occurrences")
-            st.plotly_chart(fig)
+            st.plotly_chart(occurrences_chart)
 
 
             # Display the summary
@@ -223,22 +328,22 @@ def main():
 
         submit_button = form.form_submit_button(label='Analyse')
 
-        if submit_button and uploaded_file is not None:
-            data = actionable_insights(uploaded_file, custom_parameters, insight)
+        data = analyse("actionable_insights", submit_button, uploaded_file, custom_parameters, insight)
+        if data is not None:
 
             # Display the summary and custom parameters
             st.write("Summary: " + data["summary"])
             st.write("Custom parameters: " + data["custom_parameters"])
 
             # Create a two-column table for the common feedback
-            common_feedback = pd.DataFrame(columns=["Type", "Feedback"])
-            for feedback_type, feedback_list in data.items():
-                if feedback_type.startswith("common"):
-                    for feedback in feedback_list:
-                        common_feedback = common_feedback.append({
-                            "Type": feedback_type,
-                            "Feedback": list(feedback.values())[0]
-                        }, ignore_index=True)
+            common_feedback = pd.DataFrame(
+                [
+                    (feedback_type, list(feedback.values())[0])
+                    for feedback_type, feedback_list in data.items() if feedback_type.startswith("common")
+                    for feedback in feedback_list
+                ],
+                columns=["Type", "Feedback"],
+            )
             st.write("Common Feedback:")
             st.table(common_feedback)
                 
@@ -0,0 +1,84 @@
+import os
+import re
+import threading
+
+import numpy as np
+from cachetools import TTLCache
+
+QA_CACHE_SIZE = int(os.getenv("PARABLE_QA_CACHE_SIZE", 1024))
+QA_CACHE_TTL = int(os.getenv("PARABLE_QA_CACHE_TTL", 60 * 60))
+# Cosine similarity above which a new question reuses a cached question's
+# retrieval results, e.g. 0.95. Unset means only identical questions hit.
+QA_SIMILARITY = float(os.getenv("PARABLE_QA_SIMILARITY") or 0) or None
+
+
+def normalise_question(question):
+    return re.sub(r"\s+", " ", question).strip().lower()
+
+
+class QACache:
+    # Two levels, both LRU with a TTL:
+    #   results: question -> (question embedding, retrieved chunk ids)
+    #   answers: (question, retrieved chunk ids) -> answer text
+    # Everything is dropped when the index version changes.
+
+    def __init__(self, maxsize=QA_CACHE_SIZE, ttl=QA_CACHE_TTL, threshold=QA_SIMILARITY):
+        self.threshold = threshold
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.answers = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.version = None
+        self.lock = threading.Lock()
+        self.stats = {"retrieval_hits": 0, "semantic_hits": 0, "answer_hits": 0, "misses": 0}
+
+    def sync(self, index):
+        with self.lock:
+            if self.version != index.version:
+                self.results.clear()
+                self.answers.clear()
+                self.version = index.version
+
+    def similar(self, vector, k):
+        # Top k retrieval results of the closest cached question, if close
+        # enough; only questions retrieved with at least k results qualify
+        with self.lock:
+            entries = [entry for (_, cached_k), entry in self.results.items() if cached_k >= k]
+        if not entries:
+            return None
+        matrix = np.vstack([entry[0] for entry in entries])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        return entries[best][1][:k] if scores[best] >= self.threshold else None
+
+    def retrieve(self, index, question, k):
+        # Chunk ids for `question`, re-embedding and searching only on a miss
+        self.sync(index)
+        key = (normalise_question(question), k)
+        with self.lock:
+            entry = self.results.get(key)
+        if entry is not None:
+            self.stats["retrieval_hits"] += 1
+            return entry[1]
+
+        vector = np.asarray(index.embeddings.embed_query(question), dtype="float32")
+        unit = vector / (np.linalg.norm(vector) or 1)
+        ids = self.similar(unit, k) if self.threshold else None
+        if ids is not None:
+            self.stats["semantic_hits"] += 1
+        else:
+            ids = index.hybrid_ids(question, vector, k)
+        with self.lock:
+            self.results[key] = (unit, ids)
+        return ids
+
+    def answer(self, question, ids, compute):
+        key = (normalise_question(question), tuple(ids))
+        with self.lock:
+            answer = self.answers.get(key)
+        if answer is not None:
+            self.stats["answer_hits"] += 1
+            return answer
+        self.stats["misses"] += 1
+        answer = compute()
+        with self.lock:
+            self.answers[key] = answer
+        return answer
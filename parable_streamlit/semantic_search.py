@@ -1,62 +1,259 @@
 from langchain.llms import OpenAI
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
 from langchain.docstore.document import Document
-import requests
-from google.colab import drive
+import codecs
+import csv
+import hashlib
+import json
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PyPDF2 import PdfReader
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores.faiss import FAISS
-from langchain.text_splitter import CharacterTextSplitter
-import pickle
-import os
+from tqdm import tqdm
+from vector_index import VectorIndex
+from embeddings import get_embeddings
+from qa_cache import QACache
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parable_core.chunking import chunk_pages
+from parable_core.ingestion import iter_document, iter_pdf_pages
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+INDEX_PATH = os.getenv("PARABLE_INDEX_PATH", "search_index")
+# Memory-map the saved inverted lists of an IVF index instead of reading them
+# in (other index types are always read in). Mapped lists cannot be changed,
+# so only set this where the process just answers questions.
+INDEX_MMAP = os.getenv("PARABLE_INDEX_MMAP", "") == "1"
+# Chunks of about a paragraph, overlapping by a sentence or two
+CHUNK_TOKENS = int(os.getenv("PARABLE_CHUNK_TOKENS", 256))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("PARABLE_CHUNK_OVERLAP_TOKENS", 32))
 
 def get_pdf_data(file_path, num_pages = 1):
+  # One Document per page so chunks can point back at where they came from
   reader = PdfReader(file_path)
-  full_doc_text = ""
+  pages = []
   for page in range(len(reader.pages)):
     current_page = reader.pages[page]
-    text = current_page.extract_text()
-    full_doc_text += text
+    text = current_page.extract_text() or ""
+    pages.append(Document(page_content=text, metadata={"source": file_path, "page": page + 1}))
 
-
-  return Document(
-        page_content=full_doc_text,
-        metadata = {"source": file_path} 
-    )
+  return pages
 
 def source_docs(file):
-    return [get_pdf_data(file)]
+    return get_pdf_data(file)
+
+
+# Loaded once per process and kept in memory; search_index() updates it in place
+_index = None
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = VectorIndex.load(INDEX_PATH, get_embeddings(), mmap=INDEX_MMAP)
+    return _index
 
 
 def search_index(source_docs):
-    source_chunks = []
-    splitter = CharacterTextSplitter(separator=" ", chunk_size=1024, chunk_overlap=0)
+    # Replaces the chunks of each given source and leaves the rest of the
+    # corpus, and its embeddings, untouched
+    index = get_index()
+    pages_by_source = {}
+    for doc in source_docs:
+        pages_by_source.setdefault(doc.metadata["source"], []).append(doc)
+
+    # One delete for all the sources: HNSW indexes rebuild on every delete
+    index.delete_sources(pages_by_source)
+    for source, pages in pages_by_source.items():
+        source_chunks = []
+        for chunk, provenance in chunk_pages(
+            ((doc.metadata.get("page", 1), doc.page_content) for doc in pages),
+            CHUNK_TOKENS,
+            CHUNK_OVERLAP_TOKENS,
+        ):
+            source_chunks.append(Document(page_content=chunk, metadata={"source": source, **provenance}))
+        index.add_documents(source_chunks)
+    index.save(INDEX_PATH)
+
+
+def delete_source(source):
+    index = get_index()
+    removed = index.delete_source(source)
+    index.save(INDEX_PATH)
+    return removed
+
+
+CORPUS_EXTENSIONS = (".pdf", ".docx", ".csv", ".txt")
+MANIFEST_FILE = "manifest.json"
+# While ingesting, the index and manifest are saved at least this often, so
+# an interrupted run keeps what it has indexed
+SAVE_SECONDS = 60
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def csv_rows(f):
+    # Every row after the header, cells joined as in the analysis prompts.
+    # Unlike CsvPreparation this keeps every column and every row, and adds
+    # no header or summary lines that could come back as search hits.
+    reader = csv.reader(codecs.iterdecode(f, "utf-8-sig", errors="replace"))
+    next(reader, None)
+    for row in reader:
+        cells = [cell.strip() for cell in row if cell.strip()]
+        if cells:
+            yield " | ".join(cells)
+
+
+def extract_chunks(path, previous_hash=None):
+    # Runs in a worker process: hash the file, and unless it is unchanged,
+    # extract and chunk it. Returns (path, hash, chunks or None if skipped).
+    digest = file_hash(path)
+    if digest == previous_hash:
+        return path, digest, None
+    with open(path, "rb") as f:
+        if path.lower().endswith(".pdf"):
+            pages = list(enumerate(iter_pdf_pages(f), start=1))
+        elif path.lower().endswith(".csv"):
+            pages = [(1, "\n\n".join(csv_rows(f)))]
+        else:
+            # Paragraphs and rows stay separated by blank lines so the chunker
+            # treats them as paragraphs
+            pages = [(1, "\n\n".join(iter_document(f, max_chars=0)))]
+    chunks = [
+        (chunk, {"source": path, **provenance})
+        for chunk, provenance in chunk_pages(pages, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+    ]
+    return path, digest, chunks
 
-    for source in source_docs:
-        for chunk in splitter.split_text(source.page_content):
-            source_chunks.append(Document(page_content=chunk, metadata=source.metadata))
-    #more likely you'll pickle this inde
-    with open("search_index.pickle", "wb") as f:
-        pickle.dump(FAISS.from_documents(source_chunks, OpenAIEmbeddings()), f)
 
+def corpus_paths(paths):
+    # Absolute paths, so the manifest matches however the corpus was named
+    if isinstance(paths, str):
+        paths = [paths]
+    return [os.path.abspath(path) for path in paths]
+
+
+def corpus_files(paths):
+    files = []
+    for path in corpus_paths(paths):
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(
+                    os.path.join(root, name) for name in sorted(names)
+                    if name.lower().endswith(CORPUS_EXTENSIONS)
+                )
+        else:
+            files.append(path)
+    return files
+
+
+def removed_files(paths, manifest):
+    # Indexed files under `paths` that no longer exist, including files of
+    # a directory that has been deleted as a whole
+    paths = corpus_paths(paths)
+    roots = tuple(os.path.join(path, "") for path in paths)
+    return [
+        path for path in manifest
+        if (path in paths or path.startswith(roots)) and not os.path.exists(path)
+    ]
+
+
+def save_progress(index, manifest):
+    # The manifest is written after the index, so a crash in between only
+    # means some files are indexed again on the next run
+    index.save(INDEX_PATH)
+    os.makedirs(INDEX_PATH, exist_ok=True)
+    with open(os.path.join(INDEX_PATH, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+
+
+def ingest_corpus(paths, workers=None):
+    # Index a directory or list of PDF/DOCX/CSV/TXT files. Extraction and
+    # chunking run in a process pool, one file per task; files whose content
+    # hash matches the last run are skipped, and files deleted since then
+    # are dropped from the index. A file that fails is reported and left for
+    # the next run. Returns {"indexed", "skipped", "removed", "errors"}.
+    index = get_index()
+    manifest_path = os.path.join(INDEX_PATH, MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = {os.path.abspath(path): digest for path, digest in json.load(f).items()}
+
+    removed = removed_files(paths, manifest)
+    index.delete_sources(removed)
+    for path in removed:
+        del manifest[path]
+
+    # Changed files are replaced in batches, at each save: deleting their old
+    # chunks one file at a time would rebuild an HNSW index per file
+    pending = []
+
+    def replace_pending():
+        index.delete_sources([path for path, _, _ in pending])
+        for path, digest, chunks in pending:
+            index.add_documents([Document(page_content=text, metadata=meta) for text, meta in chunks])
+            manifest[path] = digest
+        pending.clear()
+
+    files = [path for path in corpus_files(paths) if os.path.exists(path)]
+    indexed = skipped = 0
+    errors = {}
+    saved = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(extract_chunks, path, manifest.get(path)): path for path in files}
+        for future in tqdm(as_completed(futures), total=len(files), desc="Indexing", unit="file"):
+            try:
+                path, digest, chunks = future.result()
+            except Exception as error:
+                errors[futures[future]] = str(error) or type(error).__name__
+                continue
+            if chunks is None:
+                skipped += 1
+                continue
+            pending.append((path, digest, chunks))
+            indexed += 1
+            if time.monotonic() - saved >= SAVE_SECONDS:
+                replace_pending()
+                save_progress(index, manifest)
+                saved = time.monotonic()
+
+    replace_pending()
+    save_progress(index, manifest)
+    return {"indexed": indexed, "skipped": skipped, "removed": len(removed), "errors": errors}
+
+
+# Built on first use: the ingestion workers import this module too, and have
+# no use for an LLM client
+_chain = None
+
+def get_chain():
+    global _chain
+    if _chain is None:
+        _chain = load_qa_with_sources_chain(OpenAI(temperature=0), verbose=False, chain_type="stuff")
+    return _chain
+
+
+qa_cache = QACache()
 
-chain = load_qa_with_sources_chain(OpenAI(temperature=0),verbose=False, chain_type="stuff")
 def print_answer(question):
-    with open("search_index.pickle", "rb") as f:
-        search_index = pickle.load(f)
-        #print("type - ", type(search_index))
-    return (
-        chain(
+    index = get_index()
+    ids = qa_cache.retrieve(index, question, k=3)
+    return qa_cache.answer(
+        question,
+        ids,
+        lambda: get_chain()(
             {
-                "input_documents": search_index.similarity_search(question, k=3),
+                "input_documents": [index.document(i) for i in ids],
                 "question": question,
             },
             return_only_outputs=True,
-        )["output_text"]
-    
+        )["output_text"],
     )
-    
-
@@ -0,0 +1,206 @@
+import json
+import os
+import re
+import threading
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+
+from retrieval import BM25Index, reciprocal_rank_fusion
+
+# faiss.index_factory description for new indexes. "IDMap2,Flat" is exact
+# search; for millions of chunks use e.g. "IDMap2,IVF4096,Flat" or
+# "IDMap2,HNSW32". Indexes that need training (IVF, PQ) are served from an
+# exact index until enough vectors have been added to train them on.
+INDEX_FACTORY = os.getenv("PARABLE_FAISS_INDEX", "IDMap2,Flat")
+STAGING_FACTORY = "IDMap2,Flat"
+# Search-time knobs for approximate indexes, e.g. "nprobe=32" or "efSearch=128"
+SEARCH_PARAMS = os.getenv("PARABLE_FAISS_SEARCH_PARAMS", "")
+# faiss warns below 39 training points per cluster; PQ codebooks have 256
+TRAINING_POINTS_PER_CENTROID = 39
+IVF_LISTS = re.compile(r"IVF(\d+)")
+
+
+class VectorIndex:
+    # A FAISS index saved in FAISS's own format next to a JSON sidecar of the
+    # chunk texts and metadata. Vectors are keyed by integer ids through
+    # IndexIDMap2, so documents can be appended or removed by source without
+    # re-embedding the rest of the corpus.
+
+    INDEX_FILE = "index.faiss"
+    DOCS_FILE = "docs.json"
+
+    def __init__(self, embeddings, index=None, docs=None, next_id=0, factory=INDEX_FACTORY,
+                 staged=False, search_params=SEARCH_PARAMS):
+        self.embeddings = embeddings
+        self.index = index
+        self.docs = docs or {}
+        self.next_id = next_id
+        self.factory = factory
+        # True while `index` is the exact stand-in for an untrained `factory` index
+        self.staged = staged
+        self.search_params = search_params
+        self.lock = threading.RLock()
+        # Bumped on every change so caches of search results know to drop them
+        self.version = 0
+        # The keyword index is cheap to rebuild, so it is never written to disk
+        self.keywords = BM25Index()
+        for i, doc in self.docs.items():
+            self.keywords.add(i, doc["page_content"])
+        if index is not None:
+            self.apply_search_params()
+
+    @classmethod
+    def load(cls, path, embeddings, mmap=False):
+        # mmap=True maps an IVF index's inverted lists instead of reading them
+        # into memory. The mapped lists cannot be changed, so only use it in
+        # processes that just serve queries. Other index types, and an IVF
+        # index still staged on its exact stand-in, are always read in.
+        index_path = os.path.join(path, cls.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return cls(embeddings)
+        with open(os.path.join(path, cls.DOCS_FILE)) as f:
+            state = json.load(f)
+        factory = state.get("factory", INDEX_FACTORY)
+        staged = state.get("staged", False)
+        mappable = mmap and not staged and IVF_LISTS.search(factory)
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mappable else 0
+        index = faiss.read_index(index_path, flags)
+        docs = {int(i): doc for i, doc in state["docs"].items()}
+        return cls(embeddings, index, docs, state["next_id"], factory, staged)
+
+    def save(self, path):
+        with self.lock:
+            if self.index is None:
+                return
+            os.makedirs(path, exist_ok=True)
+            # Write to temporary names first so readers never see half an index
+            index_tmp = os.path.join(path, self.INDEX_FILE + ".tmp")
+            docs_tmp = os.path.join(path, self.DOCS_FILE + ".tmp")
+            faiss.write_index(self.index, index_tmp)
+            with open(docs_tmp, "w") as f:
+                json.dump(
+                    {"next_id": self.next_id, "factory": self.factory, "staged": self.staged, "docs": self.docs}, f
+                )
+            os.replace(index_tmp, os.path.join(path, self.INDEX_FILE))
+            os.replace(docs_tmp, os.path.join(path, self.DOCS_FILE))
+
+    def new_index(self, dimension, factory=None):
+        return faiss.index_factory(dimension, factory or self.factory)
+
+    def apply_search_params(self):
+        if self.search_params and not self.staged:
+            faiss.ParameterSpace().set_index_parameters(self.index, self.search_params)
+
+    def training_size(self):
+        lists = IVF_LISTS.search(self.factory)
+        return TRAINING_POINTS_PER_CENTROID * (int(lists.group(1)) if lists else 256)
+
+    def train_when_ready(self):
+        # Swap the exact stand-in for the configured index once it holds
+        # enough vectors to train on, so the centroids come from the corpus
+        # rather than from whichever document happened to be added first
+        if not self.staged or self.index.ntotal < self.training_size():
+            return
+        vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+        ids = faiss.vector_to_array(self.index.id_map).astype("int64")
+        index = self.new_index(self.index.d)
+        index.train(vectors)
+        index.add_with_ids(vectors, ids)
+        self.index, self.staged = index, False
+        self.apply_search_params()
+
+    def add_documents(self, documents):
+        if not documents:
+            return []
+        vectors = self.embeddings.embed_documents([d.page_content for d in documents])
+        return self.add_vectors(documents, vectors)
+
+    def add_vectors(self, documents, vectors):
+        vectors = np.asarray(vectors, dtype="float32")
+        with self.lock:
+            if self.index is None:
+                self.index = self.new_index(vectors.shape[1])
+                if not self.index.is_trained:
+                    self.index = self.new_index(vectors.shape[1], STAGING_FACTORY)
+                    self.staged = True
+                self.apply_search_params()
+            ids = np.arange(self.next_id, self.next_id + len(documents), dtype="int64")
+            self.index.add_with_ids(vectors, ids)
+            self.train_when_ready()
+            for i, document in zip(ids.tolist(), documents):
+                self.docs[i] = {"page_content": document.page_content, "metadata": document.metadata}
+                self.keywords.add(i, document.page_content)
+            self.next_id += len(documents)
+            self.version += 1
+        return ids.tolist()
+
+    def ids_for_sources(self, sources):
+        return [i for i, doc in self.docs.items() if doc["metadata"].get("source") in sources]
+
+    def delete_source(self, source):
+        return self.delete_sources([source])
+
+    def delete_sources(self, sources):
+        # All chunks of the given sources, removed from the index in one go
+        with self.lock:
+            ids = self.ids_for_sources(set(sources))
+            if ids and self.index is not None:
+                self.remove_ids(ids)
+            for i in ids:
+                del self.docs[i]
+                self.keywords.remove(i)
+            if ids:
+                self.version += 1
+        return len(ids)
+
+    def remove_ids(self, ids):
+        try:
+            self.index.remove_ids(np.asarray(ids, dtype="int64"))
+        except RuntimeError:
+            # HNSW graphs cannot drop vectors; rebuild from the stored vectors
+            # of the chunks that stay, which needs no re-embedding. This costs
+            # a full rebuild per call, so delete many sources with one
+            # delete_sources call rather than one delete_source each.
+            removed = set(ids)
+            keep = np.asarray([i for i in self.docs if i not in removed], dtype="int64")
+            vectors = np.vstack([self.index.reconstruct(int(i)) for i in keep]) if len(keep) else None
+            self.index = self.new_index(self.index.d)
+            self.apply_search_params()
+            if vectors is not None:
+                if not self.index.is_trained:
+                    self.index.train(vectors)
+                self.index.add_with_ids(vectors, keep)
+
+    def sources(self):
+        return {doc["metadata"].get("source") for doc in self.docs.values()}
+
+    def search_vector(self, vector, k=4):
+        # (id, distance) pairs, nearest first
+        with self.lock:
+            if self.index is None or not self.docs:
+                return []
+            distances, ids = self.index.search(np.asarray([vector], dtype="float32"), k)
+        return [(i, d) for i, d in zip(ids[0].tolist(), distances[0].tolist()) if i != -1]
+
+    def document(self, i):
+        doc = self.docs[i]
+        return Document(page_content=doc["page_content"], metadata=doc["metadata"])
+
+    def similarity_search(self, query, k=4):
+        vector = self.embeddings.embed_query(query)
+        return [self.document(i) for i, _ in self.search_vector(vector, k)]
+
+    def hybrid_ids(self, query, vector, k=4, candidates=20):
+        # Vector and BM25 candidates fused by reciprocal rank, so exact keyword
+        # hits (product names, SKUs) surface even when embeddings miss them
+        vector_ids = [i for i, _ in self.search_vector(vector, candidates)]
+        with self.lock:
+            keyword_ids = [i for i, _ in self.keywords.search(query, candidates)]
+        fused = reciprocal_rank_fusion([vector_ids, keyword_ids])
+        return [i for i in fused if i in self.docs][:k]
+
+    def hybrid_search(self, query, k=4, candidates=20):
+        ids = self.hybrid_ids(query, self.embeddings.embed_query(query), k, candidates)
+        return [self.document(i) for i in ids]
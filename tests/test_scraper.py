@@ -0,0 +1,186 @@
+import asyncio
+import csv
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+from aiohttp import web
+from selectorlib import Extractor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The module-level review store is created on import; keep it out of ~/.cache
+os.environ.setdefault("PARABLE_CACHE_DIR", tempfile.mkdtemp())
+
+from parable_core import scraper
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+LOCAL = ("127.0.0.1",)
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+
+async def serve(routes):
+    # A review site on a free local port; returns (runner, base URL, requested paths)
+    requested = []
+
+    async def handle(request):
+        requested.append(request.path_qs)
+        return await routes[request.path_qs](request)
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", requested
+
+
+def page(name):
+    async def handle(request):
+        return web.Response(text=fixture(name), content_type="text/html")
+    return handle
+
+
+REVIEW_PAGES = {
+    "/product-reviews/B000TEST": page("reviews_page1.html"),
+    "/product-reviews/B000TEST?pageNumber=1": page("reviews_page1.html"),
+    "/product-reviews/B000TEST?pageNumber=2": page("reviews_page2.html"),
+}
+
+
+def scrape(routes, paths, store, collection="headphones", **kwargs):
+    async def run():
+        runner, base, requested = await serve(routes)
+        try:
+            urls = [base + path for path in paths]
+            return await scraper.scrape(urls, collection, store, **kwargs), requested
+        finally:
+            await runner.cleanup()
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def store(tmp_path):
+    return scraper.ReviewStore(str(tmp_path / "reviews.sqlite3"))
+
+
+def test_parse_page():
+    extractor = Extractor.from_yaml_file(scraper.SELECTORS)
+    url = "https://www.amazon.co.uk/product-reviews/B000TEST"
+    reviews, next_page = scraper.parse_page(extractor, fixture("reviews_page1.html"), url)
+    assert [review["author"] for review in reviews] == ["Sam", "Alex"]
+    assert reviews[0]["product"] == "Acme Wireless Headphones"
+    assert reviews[0]["title"] == "Great battery"
+    assert reviews[0]["rating"] == "5 out of 5 stars"
+    assert reviews[0]["url"] == url
+    assert next_page == "https://www.amazon.co.uk/product-reviews/B000TEST?pageNumber=2"
+
+    _, next_page = scraper.parse_page(extractor, fixture("reviews_page2.html"), url)
+    assert next_page is None
+
+
+def test_scrape_follows_pages_and_skips_duplicates(store):
+    summary, requested = scrape(REVIEW_PAGES, ["/product-reviews/B000TEST"], store, hosts=LOCAL, allow_private=True)
+    assert summary == {"pages": 2, "new_reviews": 3, "errors": {}, "reviews": 3}
+    assert requested == ["/product-reviews/B000TEST", "/product-reviews/B000TEST?pageNumber=2"]
+
+    # Scraping again only adds what is new
+    summary, _ = scrape(REVIEW_PAGES, ["/product-reviews/B000TEST"], store, hosts=LOCAL, allow_private=True)
+    assert summary["pages"] == 2
+    assert summary["new_reviews"] == 0
+    assert summary["reviews"] == 3
+
+
+def test_scrape_stores_collections_separately(store):
+    scrape(REVIEW_PAGES, ["/product-reviews/B000TEST"], store, hosts=LOCAL, allow_private=True)
+    summary, _ = scrape(
+        REVIEW_PAGES, ["/product-reviews/B000TEST?pageNumber=2"], store, collection="other", hosts=LOCAL,
+        allow_private=True,
+    )
+    assert summary["new_reviews"] == 2
+    assert store.count("headphones") == 3
+    assert store.count("other") == 2
+    assert {c["collection"]: c["reviews"] for c in store.collections()} == {"headphones": 3, "other": 2}
+
+    rows = list(csv.DictReader(io.TextIOWrapper(store.as_file("headphones"), encoding="utf-8")))
+    assert [row["author"] for row in rows] == ["Sam", "Alex", "Jo"]
+    assert rows[2]["content"] == "Clear sound, though the bass is a little thin."
+    assert rows[2]["url"].endswith("?pageNumber=2")
+
+
+def test_scrape_stops_at_max_pages_and_loops(store):
+    summary, requested = scrape(
+        REVIEW_PAGES, ["/product-reviews/B000TEST"], store, max_pages=1, hosts=LOCAL, allow_private=True
+    )
+    assert summary["pages"] == 1
+    assert requested == ["/product-reviews/B000TEST"]
+
+    # Page 2 links back to page 1, which is not fetched twice
+    summary, requested = scrape(
+        REVIEW_PAGES, ["/product-reviews/B000TEST?pageNumber=1"], store, hosts=LOCAL, allow_private=True
+    )
+    assert requested == ["/product-reviews/B000TEST?pageNumber=1", "/product-reviews/B000TEST?pageNumber=2"]
+
+    # More than MAX_PAGES is never followed
+    summary, _ = scrape(
+        REVIEW_PAGES, ["/product-reviews/B000TEST"], store, max_pages=10 ** 6, hosts=LOCAL, allow_private=True
+    )
+    assert summary["pages"] <= scraper.MAX_PAGES
+
+
+@pytest.mark.parametrize("url", [
+    "file:///etc/passwd",
+    "ftp://www.amazon.co.uk/reviews",
+    "https://example.com/reviews",
+    "https://amazon.co.uk.example.com/reviews",
+    "http://127.0.0.1/reviews",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://[::1]/reviews",
+    "http://10.0.0.8/reviews",
+])
+def test_check_url_refuses(url):
+    with pytest.raises(scraper.BlockedURL):
+        scraper.check_url(url, hosts=scraper.SCRAPE_HOSTS + ("127.0.0.1", "169.254.169.254", "::1", "10.0.0.8"))
+
+
+def test_check_url_allows():
+    assert scraper.check_url("https://www.amazon.co.uk/product-reviews/B000TEST")
+    assert scraper.check_url("https://amazon.com/product-reviews/B000TEST")
+
+
+def test_scrape_refuses_names_resolving_to_private_addresses(store):
+    async def run():
+        runner, base, requested = await serve(REVIEW_PAGES)
+        try:
+            url = base.replace("127.0.0.1", "localhost") + "/product-reviews/B000TEST"
+            return url, await scraper.scrape([url], "headphones", store, hosts=("localhost",)), requested
+        finally:
+            await runner.cleanup()
+
+    url, summary, requested = asyncio.run(run())
+    assert "non-public" in summary["errors"][url]
+    assert summary["reviews"] == 0
+    assert requested == []
+
+
+def test_scrape_checks_redirects(store):
+    async def moved(request):
+        raise web.HTTPFound("http://169.254.169.254/latest/meta-data/")
+
+    summary, requested = scrape(
+        {"/moved": moved}, ["/moved"], store, hosts=LOCAL + ("169.254.169.254",), allow_private=False
+    )
+    assert summary["errors"]
+    assert requested == []
+
+    summary, requested = scrape({"/moved": moved}, ["/moved"], store, hosts=LOCAL, allow_private=True)
+    url = next(iter(summary["errors"]))
+    assert "not an allowed scrape host" in summary["errors"][url]
+    assert requested == ["/moved"]